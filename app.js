@@ -12,6 +12,7 @@ var selector = {
   'pdbid': document.getElementById('pdbidSelector'),
   'chainid': document.getElementById('chainidSelector'),
   'metric': document.getElementById('metricSelector'),
+  'region': document.getElementById('regionSelector'),
 };
 
 // ** Data
@@ -19,9 +20,14 @@ var selector = {
 const github_paths = [
   `https://raw.githubusercontent.com/matsengrp/gcreplay-viz/main`,
 ]
-const github_path = github_paths[0];
+// Base url for `data/`, overridable with `?data_base=<url>` (e.g. a local `scripts/serve.py`).
+const github_path = (new URLSearchParams(window.location.search).get('data_base') || github_paths[0]).replace(/\/+$/, '');
 const summary_db_path = `${github_path}/data/metadata/summary.json`;
+const dmsviz_jsons_path = `${github_path}/data/dmsviz-jsons`;
 var summary_db = null;
+// Whole-chain datasets are listed under this region.
+const region_all = 'ALL';
+const region_all_long_name = 'All Regions';
 
 const sidebar_btn_txt = {
   'open': `<<<`,
@@ -32,6 +38,7 @@ var prompt = {
   'pdbid': 'Select by PDB',
   'chainid': 'Select by Chain ID',
   'metric': 'Select by Metric',
+  'region': 'Select by Region',
 };
 
 // Template for dms-viz.github.io query string.
@@ -126,6 +133,11 @@ class Utility {
 
   static async load_summary_db() {
     summary_db = await Utility.load_json(summary_db_path);
+    // manifests written before region partitioning only list whole-chain datasets
+    summary_db.forEach(item => {
+      item['region'] = item['region'] || region_all;
+      item['region_long_name'] = item['region_long_name'] || region_all_long_name;
+    });
     summary_db = new JsonTable(summary_db, 'row');
     return summary_db;
   }
@@ -158,17 +170,8 @@ class Utility {
     return str.split(delim)[0];
   }
 
-  static check_file_exists(file_url, do_log = false) {
-    var http = new XMLHttpRequest();
-    http.open('HEAD', file_url, false);
-    http.send();
-    if (http.status === 200) {
-      Utility.log(`File exists: ${file_url}`, do_log);
-      return true;
-    } else {
-      Utility.log(`File does NOT exist: ${file_url}`, do_log);
-      return false;
-    }
+  static dataset_url(file_name) {
+    return `${dmsviz_jsons_path}/${file_name}`;
   }
 
   static query_matches(data, query) {
@@ -313,7 +316,7 @@ class Event {
     alert_message_box.innerHTML += HTMLHelper.p(text);
 
     if (alert_color) {
-      Event.alert_color(alert_color);
+      Event.alert_set_color(alert_color);
     }
   }
 
@@ -348,19 +351,28 @@ class Event {
         }
       }
     }
+    // without a region, load the whole-chain dataset
+    if (!('region' in filter)) {
+      filter['region'] = region_all;
+    }
 
     const matches = summary_db.data.filter(item =>
       Object.entries(filter).every(([key, val]) => item[key] == val)
     );
-    const match = matches[0];
     console.log(`matches found: ${matches.length}`)
     console.log(matches)
+    if (matches.length == 0) {
+      const fields = Object.entries(filter).map(([key, val]) => `<b>${key}</b>: ${val}`);
+      Event.alert_set_text(`No dataset for this selection: ${fields.join(', ')}`, false, 'alert-danger');
+      return false;
+    }
+    const match = matches[0];
 
     // get copy of request and fill fields
     const my_dms_viz_request = JSON.parse(JSON.stringify(dms_viz_request));
     my_dms_viz_request.name = match['description'];
     const file_name = match['dmsviz_filepath'];
-    my_dms_viz_request.data = `${github_path}/data/dmsviz-jsons/${file_name}`;
+    my_dms_viz_request.data = Utility.dataset_url(file_name);
 
     // log request
     var alert_text = `Loading pdb...\n`
@@ -368,11 +380,13 @@ class Event {
     alert_text += HTMLHelper.li(`<b>PDB</b>: ${match['pdbid_long_name']}`);
     alert_text += HTMLHelper.li(`<b>Chain ID</b>: ${match['chainid_long_name']}`);
     alert_text += HTMLHelper.li(`<b>Metric</b>: ${match['metric_long_name']}`);
+    alert_text += HTMLHelper.li(`<b>Region</b>: ${match['region_long_name']}`);
     alert_text += HTMLHelper.ul_close();
-    Event.alert_set_text(alert_text)
+    Event.alert_set_text(alert_text, false, 'alert-success')
 
     console.log(my_dms_viz_request);
     Event.submit_dms_viz_request(my_dms_viz_request);
+    return true;
   }
 
   static load_pdb_from_query_string() {
@@ -405,6 +419,14 @@ class Event {
     return Array.from(seen.values());
   }
 
+  static populate_region_dropdown() {
+    // only regions that exist for the selected pdbid/chainid
+    const data = summary_db.data.filter(item =>
+      ['pdbid', 'chainid'].every(key => (selector[key].value === "") || (item[key] == selector[key].value))
+    );
+    Event.populate_dropdown_from_data(selector['region'], data, 'region', 'region_long_name');
+  }
+
   static populate_dropdown_from_data(menu_elem, data, value_field, text_field) {
     const prompt_text = prompt[value_field]
     menu_elem.innerHTML = `<option value="">-- ${prompt_text} --</option>`;
@@ -438,10 +460,13 @@ document.addEventListener('DOMContentLoaded', async function () {
   Event.populate_dropdown_from_data(selector['pdbid'], summary_db.data, 'pdbid', 'pdbid_long_name');
   Event.populate_dropdown_from_data(selector['chainid'], summary_db.data, 'chainid', 'chainid_long_name');
   Event.populate_dropdown_from_data(selector['metric'], summary_db.data, 'metric', 'metric_long_name');
+  Event.populate_region_dropdown();
 
   // Event buttons
   sidebar_toggle_button.addEventListener('click', Event.sidebar_toggle);
   pdb_inspect_button.addEventListener('click', () => Event.load_pdb());
+  selector['pdbid'].addEventListener('change', Event.populate_region_dropdown);
+  selector['chainid'].addEventListener('change', Event.populate_region_dropdown);
 
   // Pre-load data
   Event.load_pdb({ 'pdbid': 'CGG', 'chainid': 'ALL', 'metric': 'all_metrics' });
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import os,sys
+import argparse
+import time
+import resource
+import multiprocessing
+import pandas as pd
+
+from utility import *
+from pipeline import metric_get_binding_df, METRIC_NAMES
+
+
+def get_max_rss_mb():
+    # linux reports ru_maxrss in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def bench_build(metric_path, chainids, use_schema):
+    rss_before = get_max_rss_mb()
+    start = time.perf_counter()
+    metric_df = metric_get_binding_df(
+        pdb_df=None,
+        metric_path=metric_path,
+        chainids=chainids,
+        use_schema=use_schema)
+    build_time = time.perf_counter() - start
+    peak_mb = get_max_rss_mb() - rss_before
+    return metric_df, build_time, peak_mb
+
+
+def bench_filters(metric_df, repeat=20):
+    # the filters run on every (pdb, chain, metric) in the pipeline
+    metric_cols = METRIC_NAMES["bind_expr"]
+    sites = list(metric_df["position_IMGT"].unique()[::2])
+    filters = {
+        "condition_isin": lambda: metric_df[metric_df["condition"].isin(metric_cols)],
+        "site_isin": lambda: metric_df[metric_df["position_IMGT"].isin(sites)],
+        "drop_duplicates": lambda: metric_df.drop_duplicates(subset=["position", "mutant"]),
+        "groupby_site": lambda: metric_df.groupby(["condition", "site"], observed=True)["factor"].mean(),
+    }
+    times = {}
+    for name, fn in filters.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        times[name] = (time.perf_counter() - start) / repeat
+    return times
+
+
+def bench_run(metric_path, chainids, use_schema, repeat):
+    # runs in a fresh process, so the peak rss of one mode does not hide the other
+    metric_df, build_time, peak_mb = bench_build(metric_path, chainids, use_schema)
+    result = {
+        "rows": len(metric_df),
+        "build_s": build_time,
+        "peak_mb": peak_mb,
+        "frame_mb": metric_df.memory_usage(deep=True).sum() / 2**20,
+    }
+    for name, filter_time in bench_filters(metric_df, repeat=repeat).items():
+        result[f"{name}_ms"] = filter_time * 1000
+    return result
+
+
+def parse_args(args):
+    arg_parser = argparse.ArgumentParser("gcreplay-viz schema benchmark")
+    arg_parser.add_argument("--metric-path", type=Parser.parse_input_file(), help="metric csv", default="../data/input/naive_reversions_first.csv")
+    arg_parser.add_argument("--chain-id", type=Parser.parse_list(str), help="chain ids", default=["H"])
+    arg_parser.add_argument("--repeat", type=int, help="repeats per filter", default=20)
+    parser = Parser(arg_parser=arg_parser)
+    args = parser.parse_args(args[1:])
+    return args
+
+
+### MAIN ###
+
+
+def main(args=sys.argv):
+    args = parse_args(args)
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for use_schema in [False, True]:
+        label = ("typed" if use_schema else "object")
+        with context.Pool(1) as pool:
+            results[label] = pool.apply(bench_run, (args["metric_path"], args["chain_id"], use_schema, args["repeat"]))
+
+    results_df = pd.DataFrame(results)
+    results_df["ratio"] = results_df["object"] / results_df["typed"]
+    print(results_df.to_string(float_format=lambda x: f"{x:.3f}"))
+
+
+if __name__ == "__main__":
+    main()
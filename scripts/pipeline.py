@@ -1,21 +1,23 @@
 #!/usr/bin/env python3
 
 import os,sys
+import re
 import argparse
 import shutil
 import glob
-import numpy as np
-import pandas as pd
 import json
+import hashlib
 import pprint
+from collections import defaultdict, Counter
 from pathlib import Path
-import matplotlib.pyplot as plt
 
-from Bio.PDB import PDBParser,PDBIO
-from Bio.PDB.DSSP import DSSP
 from utility import *
 from utility import run_command
 
+# numpy and pandas are imported on first use, so `--help` and `--plan` start quickly
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+
 EXIT_ON_EXCEPTION = False
 # palette for binding
 DARK_PALETTE = ["#7570b3", "#808080"]  # original Dark2 pallete
@@ -26,6 +28,8 @@ COLOR_MAP = 'brg'
 # amino acid codes
 AA_ALPHABET = sorted(list("RKHDEQNSTYWFAILMVGPC"))
 AA_COUNT = len(AA_ALPHABET)
+MUTANT_ALPHABET = AA_ALPHABET + ["-"]
+RESIDUE_ALPHABET = AA_ALPHABET + ["X"]
 
 
 def mpl_rgba_to_hex(rgba):
@@ -34,6 +38,7 @@ def mpl_rgba_to_hex(rgba):
 
 
 def generate_color_palette(n_colors=10, colormap='gist_earth', as_hex=True):
+    import matplotlib.pyplot as plt
     cmap = plt.get_cmap(colormap)
     colors = [cmap(i / max(n_colors - 1, 1)) for i in range(n_colors)]
 
@@ -45,7 +50,84 @@ def generate_color_palette(n_colors=10, colormap='gist_earth', as_hex=True):
         return [tuple(color[:3]) for color in colors]
 
 
+### SCHEMA ###
+
+
+# Compact dtypes used from ingestion to output: categoricals for repeated strings
+# (with a fixed alphabet where one is known), small ints for positions and float32 for values.
+PDB_SCHEMA = {
+    "site": "int32",
+    "chainid": ("category", None),
+    "res_num": "int32",
+    "res_ins": ("category", None),
+    "aa_long": ("category", None),
+    "aa_short": ("category", RESIDUE_ALPHABET),
+}
+METRIC_SCHEMA = {
+    "site": "int16",
+    "position": "int16",
+    "position_IMGT": "int16",
+    "chain": ("category", None),
+    "wildtype": ("category", AA_ALPHABET),
+    "mutant": ("category", MUTANT_ALPHABET),
+    "annotation": ("category", None),
+    "condition": ("category", None),
+    "factor": "float32",
+}
+
+
+def get_category_dtype(values, alphabet=None):
+    # unexpected values are appended to the alphabet, so none are silently lost as NaN
+    categories = list(alphabet or [])
+    extra = sorted(set(pd.unique(values.dropna())) - set(categories))
+    return pd.CategoricalDtype(categories + extra)
+
+
+def df_apply_schema(df, schema):
+    df = df.copy(deep=False)
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+        if isinstance(dtype, tuple):
+            df[col] = df[col].astype(get_category_dtype(df[col], alphabet=dtype[1]))
+        elif dtype.startswith("float"):
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def df_melt_typed(df, id_vars, value_vars, var_name="condition", value_name="factor"):
+    # Same rows and order as `pd.melt`, but the id columns keep their dtypes and the variable
+    # column is built directly as categorical codes instead of one string per row.
+    row_index = np.tile(np.arange(len(df)), len(value_vars))
+    melt_df = df[id_vars].iloc[row_index].reset_index(drop=True)
+    var_codes = np.repeat(np.arange(len(value_vars), dtype=np.int32), len(df))
+    melt_df[var_name] = pd.Categorical.from_codes(var_codes, categories=value_vars)
+    melt_df[value_name] = np.concatenate([df[col].to_numpy() for col in value_vars]) if value_vars else []
+    return melt_df
+
+
+STRUCTURE_EXTENSIONS = [".pdb", ".cif", ".cif.gz", ".bcif", ".bcif.gz"]
+CIF_EXTENSIONS = [".cif", ".cif.gz", ".bcif", ".bcif.gz"]
+PDB_DF_COLUMNS = ['site', 'chainid', 'res_id', 'res_num', 'res_ins', 'aa_long', 'aa_short']
+
+
+def structure_get_paths(input_dir):
+    paths = []
+    for ext in STRUCTURE_EXTENSIONS:
+        paths += glob.glob(f"{input_dir}/*{ext}")
+    return sorted(paths)
+
+
+def structure_is_cif(path):
+    return any(str(path).endswith(ext) for ext in CIF_EXTENSIONS)
+
+
 def pdb_get_chainids(pdb_path):
+    if structure_is_cif(pdb_path):
+        return list(dict.fromkeys(cif_get_df(pdb_path)["chainid"]))
+    from Bio.PDB import PDBParser
     chainids = []
     parser = PDBParser(PERMISSIVE=1)
     structure = parser.get_structure(pdb_path, pdb_path)
@@ -57,6 +139,9 @@ def pdb_get_chainids(pdb_path):
 
 
 def pdb_get_df(pdb_path, chainids=None):
+    if structure_is_cif(pdb_path):
+        return cif_get_df(pdb_path, chainids=chainids)
+    from Bio.PDB import PDBParser
     parser = PDBParser(PERMISSIVE=1)
     structure = parser.get_structure(pdb_path, pdb_path)
     pdb_sites = []
@@ -79,8 +164,229 @@ def pdb_get_df(pdb_path, chainids=None):
                     aa_long = residue.resname
                     aa_short = Encoder.long2short(residue.resname)
                     pdb_sites.append((site+1, chain.id, res_id, res_num, res_ins, aa_long, aa_short))
-    df = pd.DataFrame(pdb_sites, columns=['site', 'chainid', 'res_id', 'res_num', 'res_ins', 'aa_long', 'aa_short'])
-    return df
+    df = pd.DataFrame(pdb_sites, columns=PDB_DF_COLUMNS)
+    return df_apply_schema(df, PDB_SCHEMA)
+
+
+### mmCIF / BinaryCIF ###
+
+
+CIF_ATOM_SITE_COLS = {
+    "group_PDB": "group",
+    "pdbx_PDB_model_num": "model",
+    "auth_asym_id": "chainid",
+    "auth_seq_id": "res_num",
+    "pdbx_PDB_ins_code": "res_ins",
+    "auth_comp_id": "aa_long",
+}
+# label_* columns are used when a file omits the author-provided ones
+CIF_ATOM_SITE_FALLBACK_COLS = {
+    "auth_asym_id": "label_asym_id",
+    "auth_seq_id": "label_seq_id",
+    "auth_comp_id": "label_comp_id",
+}
+
+
+def cif_get_col_map(col_names):
+    col_map = {}
+    for col, name in CIF_ATOM_SITE_COLS.items():
+        if col not in col_names:
+            col = CIF_ATOM_SITE_FALLBACK_COLS.get(col)
+        if col in col_names:
+            col_map[col] = name
+    return col_map
+
+
+def cif_get_df(cif_path, chainids=None):
+    # Same residue table as `pdb_get_df`, built from the `_atom_site` columns without per-atom objects.
+    if ".bcif" in os.path.basename(cif_path):
+        atom_df = bcif_get_atom_site_df(cif_path)
+    else:
+        atom_df = cif_get_atom_site_df(cif_path)
+    return atom_site_get_residue_df(atom_df, chainids=chainids)
+
+
+def cif_open(cif_path, mode="r"):
+    if str(cif_path).endswith(".gz"):
+        import gzip
+        return gzip.open(cif_path, mode + ("t" if mode == "r" else ""))
+    return open(cif_path, mode)
+
+
+def cif_get_atom_site_df(cif_path):
+    import io
+    with cif_open(cif_path, "r") as file:
+        text = file.read()
+
+    # locate the `_atom_site` loop: its header lines followed by its data rows
+    start = text.find("\n_atom_site.")
+    if start < 0:
+        raise Exception(f"ERROR: no _atom_site loop found in {cif_path}")
+    lines_iter = iter(text[start + 1:].splitlines())
+    col_names = []
+    for line in lines_iter:
+        if not line.startswith("_atom_site."):
+            break
+        col_names.append(line.split()[0][len("_atom_site."):])
+    data_lines = [line]
+    for line in lines_iter:
+        if line.startswith(("#", "loop_", "_", "data_")):
+            break
+        data_lines.append(line)
+
+    col_map = cif_get_col_map(col_names)
+    atom_df = pd.read_csv(
+        io.StringIO("\n".join(data_lines)),
+        sep=r"\s+",
+        header=None,
+        names=col_names,
+        usecols=list(col_map),
+        dtype=str,
+        quotechar='"',
+        na_filter=False)
+    return atom_df.rename(columns=col_map)
+
+
+def bcif_decode_column(encoded):
+    # Decodes a BinaryCIF column by applying its encodings in reverse order.
+    data = encoded["data"]
+    for encoding in reversed(encoded["encoding"]):
+        kind = encoding["kind"]
+        if kind == "ByteArray":
+            dtypes = {1: "<i1", 2: "<i2", 3: "<i4", 4: "<u1", 5: "<u2", 6: "<u4", 32: "<f4", 33: "<f8"}
+            data = np.frombuffer(data, dtype=dtypes[encoding["type"]])
+        elif kind == "FixedPoint":
+            data = data / encoding["factor"]
+        elif kind == "IntervalQuantization":
+            step = (encoding["max"] - encoding["min"]) / (encoding["numSteps"] - 1)
+            data = encoding["min"] + data * step
+        elif kind == "RunLength":
+            data = np.repeat(data[0::2], data[1::2])
+        elif kind == "Delta":
+            data = np.cumsum(data, dtype=np.int64) + encoding["origin"]
+        elif kind == "IntegerPacking":
+            bits = 8 * encoding["byteCount"]
+            if encoding["isUnsigned"]:
+                is_end = (data != (2 ** bits - 1))
+            else:
+                is_end = (data != (2 ** (bits - 1) - 1)) & (data != -(2 ** (bits - 1)))
+            group_ids = np.concatenate([[0], np.cumsum(is_end)[:-1]])
+            data = np.bincount(group_ids, weights=data.astype(np.int64)).astype(np.int64)
+        elif kind == "StringArray":
+            offsets = bcif_decode_column({"data": encoding["offsets"], "encoding": encoding["offsetEncoding"]})
+            indices = bcif_decode_column({"data": data, "encoding": encoding["dataEncoding"]})
+            string_data = encoding["stringData"]
+            strings = np.array([string_data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)] + [""])
+            # index -1 (missing) selects the trailing empty string
+            data = strings[indices]
+        else:
+            raise Exception(f"ERROR: unsupported BinaryCIF encoding: {kind}")
+    return data
+
+
+def bcif_get_atom_site(bcif_path):
+    # Returns the first data block of a BinaryCIF file and its `_atom_site` category.
+    import msgpack
+    with cif_open(bcif_path, "rb") as file:
+        bcif_data = msgpack.unpackb(file.read(), raw=False)
+
+    block = bcif_data["dataBlocks"][0]
+    for category in block["categories"]:
+        if category["name"] == "_atom_site":
+            return block, category
+    raise Exception(f"ERROR: no _atom_site category found in {bcif_path}")
+
+
+def bcif_get_atom_site_df(bcif_path):
+    _, atom_site = bcif_get_atom_site(bcif_path)
+    col_map = cif_get_col_map([column["name"] for column in atom_site["columns"]])
+    columns = {}
+    for column in atom_site["columns"]:
+        if column["name"] in col_map:
+            values = bcif_decode_column(column["data"]).astype(str)
+            if column.get("mask") is not None:
+                # masked values are not present ('.') or unknown ('?')
+                mask = bcif_decode_column(column["mask"])
+                values = np.where(mask == 0, values, ".")
+            columns[column["name"]] = values
+    atom_df = pd.DataFrame(columns)
+    return atom_df.rename(columns=col_map)
+
+
+def cif_quote(value):
+    if value == "":
+        return "."
+    if any(c.isspace() for c in value) or value[0] in "_#$'\"[];" or value.lower() in ["data_", "loop_", "stop_", "global_"]:
+        return (f"'{value}'" if '"' in value else f'"{value}"')
+    return value
+
+
+def bcif_write_cif(bcif_path, cif_path):
+    # Transcodes the `_atom_site` category of a BinaryCIF file into a text mmCIF file.
+    block, atom_site = bcif_get_atom_site(bcif_path)
+    col_names = []
+    col_values = []
+    for column in atom_site["columns"]:
+        values = bcif_decode_column(column["data"])
+        if values.dtype.kind == "f":
+            values = np.round(values, 4)
+        values = values.astype(str)
+        # quote each distinct value once
+        values, inverse = np.unique(values, return_inverse=True)
+        values = np.array([cif_quote(value) for value in values], dtype=object)[inverse]
+        if column.get("mask") is not None:
+            # masked values are not present ('.') or unknown ('?')
+            mask = bcif_decode_column(column["mask"])
+            values = np.where(mask == 0, values, np.where(mask == 1, ".", "?"))
+        col_names.append(column["name"])
+        col_values.append(values)
+
+    with open(cif_path, "w") as file:
+        file.write(f"data_{block.get('header') or 'structure'}\n#\nloop_\n")
+        for col_name in col_names:
+            file.write(f"_atom_site.{col_name}\n")
+        for row in zip(*col_values):
+            file.write(" ".join(row) + "\n")
+        file.write("#\n")
+    return cif_path
+
+
+def structure_get_text_path(pdb_path, temp_dir):
+    # configure-dms-viz reads plain text structures, so compressed and BinaryCIF inputs are written out as text mmCIF.
+    if not structure_is_cif(pdb_path) or str(pdb_path).endswith(".cif"):
+        return pdb_path
+    cif_path = f"{temp_dir}/{pdb_get_prefix(pdb_path)}.cif"
+    if ".bcif" in os.path.basename(pdb_path):
+        return bcif_write_cif(pdb_path, cif_path)
+    with cif_open(pdb_path, "rb") as in_file, open(cif_path, "wb") as out_file:
+        shutil.copyfileobj(in_file, out_file)
+    return cif_path
+
+
+def atom_site_get_residue_df(atom_df, chainids=None):
+    if "model" not in atom_df.columns:
+        atom_df = atom_df.assign(model="1")
+    if "group" not in atom_df.columns:
+        atom_df = atom_df.assign(group="ATOM")
+    if chainids is not None:
+        chainids = ([chainids] if isinstance(chainids, str) else list(chainids))
+        atom_df = atom_df[atom_df["chainid"].isin(chainids)]
+
+    # one row per residue, in order of first appearance
+    res_df = atom_df.drop_duplicates(subset=["model", "chainid", "group", "res_num", "res_ins"])
+    res_df = res_df.reset_index(drop=True)
+    res_ins = res_df["res_ins"].where(~res_df["res_ins"].isin(["?", ".", ""]), "-")
+    res_num = res_df["res_num"].astype(int)
+    res_df = pd.DataFrame({
+        "site": res_df.groupby(["model", "chainid"], sort=False).cumcount() + 1,
+        "chainid": res_df["chainid"],
+        "res_id": res_num.astype(str) + res_ins.where(res_ins != "-", ""),
+        "res_num": res_num,
+        "res_ins": res_ins,
+        "aa_long": res_df["aa_long"],
+        "aa_short": res_df["aa_long"].map(Encoder.long2short_dict).fillna("X"),
+    })
+    return df_apply_schema(res_df[PDB_DF_COLUMNS], PDB_SCHEMA)
 
 
 def pdb_get_flat_df(pdb_path):
@@ -113,46 +419,473 @@ def pdb_get_flat_df(pdb_path):
     return df
 
 
-def metric_get_binding_df(pdb_df, metric_path, chainids=None, metric_names=None):
-    raw_metric_df = pd.read_csv(metric_path)
+METRIC_ID_VARS = ["site", "position", "position_IMGT", "chain", "wildtype", "mutant"]
+METRIC_CHUNKSIZE = 100000
+
+
+def metric_check_targets(found_targets):
+    # datasets are keyed by chain only, so rows of different targets must never be merged
+    found_targets = sorted(set(str(x) for x in found_targets))
+    if len(found_targets) > 1:
+        raise Exception(f"ERROR: metric table has multiple targets {found_targets}, select one with --target")
+    return found_targets
+
+
+def metric_read_csv(metric_path, nrows=None, use_schema=True):
+    if not use_schema:
+        return pd.read_csv(metric_path, nrows=nrows)
+    # only id, label and numeric columns are read, with numbers as float32 and labels as categoricals
+    sample_df = pd.read_csv(metric_path, nrows=1000)
+    value_vars = [x for x in metric_get_numeric_conditions(sample_df) if x not in METRIC_ID_VARS]
+    label_vars = [x for x in ["target", "chain", "annotation"] if x in sample_df.columns]
+    label_dtype = {col: "category" for col in label_vars}
+    value_dtype = {col: "float32" for col in value_vars}
+    usecols = [x for x in sample_df.columns if x in METRIC_ID_VARS + label_vars + value_vars]
+    try:
+        return pd.read_csv(metric_path, nrows=nrows, usecols=usecols, dtype={**value_dtype, **label_dtype})
+    except ValueError:
+        # a column that looked numeric in the sample has text further down, so the value types
+        # are inferred from the full read, and such columns stay non-numeric as before
+        metric_df = pd.read_csv(metric_path, nrows=nrows, usecols=usecols, dtype=label_dtype)
+        value_vars = [x for x in metric_get_numeric_conditions(metric_df) if x in value_vars]
+        return metric_df.astype({col: "float32" for col in value_vars})
+
+
+def metric_get_binding_df(pdb_df, metric_path, chainids=None, metric_names=None, raw_metric_df=None, targets=None, use_schema=True):
+    # reuse an already loaded metric table if given, otherwise read from disk
+    if raw_metric_df is None:
+        raw_metric_df = metric_read_csv(metric_path, use_schema=use_schema)
+    else:
+        raw_metric_df = raw_metric_df.copy()
     raw_metric_df.loc[raw_metric_df["wildtype"] == raw_metric_df["mutant"], "mutant"] = "-"
+    if (targets is not None) and ("target" in raw_metric_df.columns):
+        raw_metric_df = raw_metric_df[raw_metric_df["target"].isin(targets)]
+    if "target" in raw_metric_df.columns:
+        metric_check_targets(raw_metric_df["target"].unique())
     if chainids is not None:
         raw_metric_df = raw_metric_df[raw_metric_df["chain"].isin(chainids)]
-        raw_metric_df["site"] = [x for x in range(1,len(set(raw_metric_df['position']))+1) for _ in range(AA_COUNT)]
+    # sites are numbered per chain by order of first appearance of each position, as in the chunked reader
+    site = raw_metric_df.groupby("chain", sort=False, observed=True)["position"].transform(lambda x: pd.factorize(x)[0] + 1)
+    raw_metric_df = raw_metric_df.assign(site=site)
 
-    id_vars = ["site", "position", "position_IMGT", "chain", "wildtype", "mutant"]
+    id_vars = METRIC_ID_VARS
     # value_vars = ["single_nt",
     #     "bind_CGG", "delta_bind_CGG", "n_bc_bind_CGG", "n_libs_bind_CGG",
     #     "expr", "delta_expr", "n_bc_expr", "n_libs_expr"]
-    value_vars = [x for x in raw_metric_df.columns if x not in id_vars]
-
-    metric_df = pd.melt(
-        raw_metric_df,
-        id_vars=id_vars,
-        value_vars=value_vars,
-        var_name="condition",
-        value_name="factor")
-    metric_df["position_IMGT"] = metric_df["position_IMGT"].astype(int)
+    value_vars = [x for x in metric_get_numeric_conditions(raw_metric_df) if x not in id_vars]
     if metric_names:
-        metric_df = metric_df[metric_df["condition"].isin(metric_names)]
+        value_vars = [x for x in value_vars if x in metric_names]
+
+    # typing before the melt keeps the repeated id columns as categorical codes
+    raw_metric_df = raw_metric_df[id_vars + value_vars]
+    if use_schema:
+        value_schema = {col: "float32" for col in value_vars}
+        raw_metric_df = df_apply_schema(raw_metric_df, {**METRIC_SCHEMA, **value_schema})
+        metric_df = df_melt_typed(
+            raw_metric_df,
+            id_vars=id_vars,
+            value_vars=value_vars,
+            var_name="condition",
+            value_name="factor")
+    else:
+        metric_df = pd.melt(
+            raw_metric_df,
+            id_vars=id_vars,
+            value_vars=value_vars,
+            var_name="condition",
+            value_name="factor")
+        metric_df["position_IMGT"] = metric_df["position_IMGT"].astype(int)
     return metric_df
 
 
-def write_sitemap_csv(pdb_df, output_path, site_count=None):
-    res_ins = [x if not x.startswith("-") else "" for x in pdb_df["res_ins"]]
-    protein_sites = [f"{num}{ins}" for num, ins in zip(pdb_df["res_num"], res_ins)]
+def metric_get_binding_df_chunked(
+    metric_path, spill_dir, chainids=None, metric_names=None, targets=None,
+    chunksize=METRIC_CHUNKSIZE, extra_id_vars=["annotation"],
+    derived_metrics=None, derived_totals=None,
+):
+    # Streams the metric table in chunks, filtering by target/chain and conditions before melting.
+    # Each (target, chain) partition is appended to its own csv in `spill_dir`, so peak memory of
+    # this pass is bounded by `chunksize` rather than by the table size. Returns {partition: spill_path}.
+    os.makedirs(spill_dir, exist_ok=True)
+    # column names and types are taken from a small sample of the table
+    sample_df = pd.read_csv(metric_path, nrows=1000)
+    header = list(sample_df.columns)
+    has_target = ("target" in header)
+    id_vars = METRIC_ID_VARS + [x for x in extra_id_vars if x in header]
+    value_vars = [x for x in metric_get_numeric_conditions(sample_df) if x not in id_vars]
+    value_vars += derived_get_conditions(derived_metrics)
+    if metric_names:
+        value_vars = [x for x in value_vars if x in metric_names]
+    # `site` is renumbered below, so it is never read from the table
+    cohort_vars = (derived_get_cohort_cols(header) if derived_metrics else [])
+    usecols = [x for x in header if (x in id_vars + value_vars + cohort_vars + ["target"]) and (x != "site")]
+    partition_cols = (["target", "chain"] if has_target else ["chain"])
+
+    site_maps = {}
+    spill_paths = {}
+    for chunk in pd.read_csv(metric_path, usecols=usecols, chunksize=chunksize):
+        if chainids is not None:
+            chunk = chunk[chunk["chain"].isin(chainids)]
+        if (targets is not None) and has_target:
+            chunk = chunk[chunk["target"].isin(targets)]
+        if len(chunk) == 0:
+            continue
+        chunk = chunk.copy()
+        chunk.loc[chunk["wildtype"] == chunk["mutant"], "mutant"] = "-"
+        chunk["position_IMGT"] = chunk["position_IMGT"].astype(int)
+        if derived_metrics:
+            chunk = metric_add_derived(chunk, derived_metrics, totals=derived_totals)
+
+        for key, part_df in chunk.groupby(partition_cols, sort=False):
+            key = key if isinstance(key, tuple) else (key,)
+            # sites are numbered by order of first appearance of each position, across chunks
+            site_map = site_maps.setdefault(key, {})
+            for position in part_df["position"].unique():
+                site_map.setdefault(position, len(site_map) + 1)
+            part_df = part_df.assign(site=part_df["position"].map(site_map))
+            part_metric_df = pd.melt(
+                part_df,
+                id_vars=id_vars,
+                value_vars=value_vars,
+                var_name="condition",
+                value_name="factor")
+
+            if key not in spill_paths:
+                spill_paths[key] = os.path.join(spill_dir, f"{'.'.join(map(str, key))}.metric.csv")
+                part_metric_df.to_csv(spill_paths[key], index=False, mode="w")
+            else:
+                part_metric_df.to_csv(spill_paths[key], index=False, mode="a", header=False)
+    if has_target:
+        metric_check_targets([key[0] for key in spill_paths])
+    return spill_paths
+
+
+### DERIVED METRICS ###
+
+
+# Derived metrics are declared as {name: {"stat": stat, "cohorts": [cohort, ...]}} and computed
+# from the per-cohort `mutation events (<cohort>)` and `mutation abundance (<cohort>)` columns:
+#   events                     - summed events over the cohorts
+#   abundance                  - summed abundance over the cohorts
+#   event_share                - events as a fraction of all events of the chain
+#   log2_abundance_over_events - log2 of the abundance share over the event share, within the chain
+# Summing events or abundance over 15-day+20-day reproduces the table's `mutation events` and
+# `mutation abundance`. The two shares are not the table's model-based `mutation rate` and
+# `mutation enrichment`, so they are named and labelled apart from them.
+DERIVED_STATS = ["events", "abundance", "event_share", "log2_abundance_over_events"]
+DERIVED_STAT_LONG_NAMES = {
+    "events": "Mutation Events",
+    "abundance": "Mutation Abundance",
+    "event_share": "Mutation Event Share",
+    "log2_abundance_over_events": "Log2 Abundance Share over Event Share",
+}
+DERIVED_COHORT_PATTERN = r"^mutation (events|abundance) \((.+)\)$"
+
+
+def derived_get_cohorts(columns):
+    # cohorts that have both an events and an abundance column
+    found = {"events": [], "abundance": []}
+    for col in columns:
+        match = re.match(DERIVED_COHORT_PATTERN, col)
+        if match:
+            found[match.group(1)].append(match.group(2))
+    return [x for x in found["events"] if x in found["abundance"]]
+
+
+def derived_get_cohort_cols(columns):
+    cohorts = derived_get_cohorts(columns)
+    return [f"mutation {kind} ({cohort})" for cohort in cohorts for kind in ["events", "abundance"]]
+
+
+def derived_get_condition(spec):
+    # bracketed, so the label never collides with the upstream "mutation <kind> (<cohort>)" columns
+    return f"{DERIVED_STAT_LONG_NAMES[spec['stat']]} [{'+'.join(spec['cohorts'])}]"
+
+
+def derived_get_conditions(derived_metrics):
+    return [derived_get_condition(spec) for spec in (derived_metrics or {}).values()]
+
+
+def derived_get_long_name(spec):
+    return f"{DERIVED_STAT_LONG_NAMES[spec['stat']]} ({', '.join(spec['cohorts'])})"
+
+
+def parse_derived(derived_str):
+    # argparse type, "event_share:15-day+20-day" -> ("mut_event_share_15-day_20-day", {"stat": "event_share", "cohorts": ["15-day", "20-day"]})
+    stat, _, cohorts = derived_str.partition(":")
+    cohorts = [x for x in cohorts.split("+") if x != ""]
+    if (stat not in DERIVED_STATS) or (len(cohorts) == 0):
+        raise argparse.ArgumentTypeError(f"Invalid derived metric: '{derived_str}'. Expected format: <{'|'.join(DERIVED_STATS)}>:<cohort>+<cohort>")
+    return (f"mut_{stat}_{'_'.join(cohorts)}", {"stat": stat, "cohorts": cohorts})
+
+
+def derived_parse(derived_items):
+    # {name: spec} from derived metric strings, or from items already parsed by `parse_derived`
+    derived_metrics = {}
+    for item in (derived_items or []):
+        name, spec = (parse_derived(item) if isinstance(item, str) else item)
+        derived_metrics[name] = spec
+    return derived_metrics
+
+
+def derived_get_sums(raw_metric_df, derived_metrics):
+    # summed events and abundance for every derived metric, as one matrix product over the grid
+    cohorts = derived_get_cohorts(raw_metric_df.columns)
+    names = list(derived_metrics)
+    cohort_mask = np.zeros((len(cohorts), len(names)))
+    for j, name in enumerate(names):
+        for cohort in derived_metrics[name]["cohorts"]:
+            if cohort not in cohorts:
+                raise Exception(f"ERROR: derived metric '{name}' uses unknown cohort '{cohort}' (expected one of {cohorts})")
+            cohort_mask[cohorts.index(cohort), j] = 1
+    events = raw_metric_df[[f"mutation events ({x})" for x in cohorts]].to_numpy(dtype="float64")
+    abundance = raw_metric_df[[f"mutation abundance ({x})" for x in cohorts]].to_numpy(dtype="float64")
+    events_df = pd.DataFrame(events @ cohort_mask, columns=names, index=raw_metric_df.index)
+    abundance_df = pd.DataFrame(abundance @ cohort_mask, columns=names, index=raw_metric_df.index)
+    return events_df, abundance_df
+
+
+def derived_get_totals(raw_metric_df, derived_metrics):
+    # per-chain totals, the denominators of the event and abundance shares
+    events_df, abundance_df = derived_get_sums(raw_metric_df, derived_metrics)
+    chains = raw_metric_df["chain"].astype(str)
+    return events_df.groupby(chains).sum(), abundance_df.groupby(chains).sum()
+
+
+def derived_get_totals_chunked(metric_path, derived_metrics, chainids=None, targets=None, chunksize=METRIC_CHUNKSIZE):
+    # first streaming pass for chunked ingestion, reading only the chain, target and cohort columns
+    header = list(pd.read_csv(metric_path, nrows=0).columns)
+    usecols = [x for x in header if x in ["chain", "target"] + derived_get_cohort_cols(header)]
+    events_totals, abundance_totals = None, None
+    for chunk in pd.read_csv(metric_path, usecols=usecols, chunksize=chunksize):
+        if chainids is not None:
+            chunk = chunk[chunk["chain"].isin(chainids)]
+        if (targets is not None) and ("target" in chunk.columns):
+            chunk = chunk[chunk["target"].isin(targets)]
+        events_df, abundance_df = derived_get_totals(chunk, derived_metrics)
+        events_totals = events_df if events_totals is None else events_totals.add(events_df, fill_value=0)
+        abundance_totals = abundance_df if abundance_totals is None else abundance_totals.add(abundance_df, fill_value=0)
+    return events_totals, abundance_totals
+
+
+def metric_add_derived(raw_metric_df, derived_metrics, totals=None):
+    # Adds one float32 condition column per derived metric to the wide (site x mutant) table.
+    # `totals` are computed from the table itself unless given (e.g. when it is only a chunk).
+    if not derived_metrics:
+        return raw_metric_df
+    events_df, abundance_df = derived_get_sums(raw_metric_df, derived_metrics)
+    if totals is None:
+        totals = derived_get_totals(raw_metric_df, derived_metrics)
+    chains = raw_metric_df["chain"].astype(str)
+    events_total = totals[0].reindex(chains).to_numpy()
+    abundance_total = totals[1].reindex(chains).to_numpy()
+    events = events_df.to_numpy()
+    abundance = abundance_df.to_numpy()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = {
+            "events": events,
+            "abundance": abundance,
+            "event_share": np.where(events > 0, events / events_total, np.nan),
+            "log2_abundance_over_events": np.where(
+                (events > 0) & (abundance > 0),
+                np.log2((abundance / abundance_total) / (events / events_total)),
+                np.nan),
+        }
+    raw_metric_df = raw_metric_df.copy(deep=False)
+    for j, (name, spec) in enumerate(derived_metrics.items()):
+        raw_metric_df[derived_get_condition(spec)] = values[spec["stat"]][:, j].astype("float32")
+    return raw_metric_df
+
+
+def metric_read_spill(spill_paths, chainid):
+    # the partition key ends with the chain id
+    # the whole partition is loaded in long format, so this holds one chain's rows x the spilled conditions
+    paths = [path for key, path in spill_paths.items() if key[-1] == chainid]
+    if len(paths) == 0:
+        metric_df = pd.DataFrame(columns=METRIC_ID_VARS + ["condition", "factor"])
+    else:
+        metric_df = pd.concat([pd.read_csv(path, float_precision="round_trip") for path in paths], ignore_index=True)
+    return df_apply_schema(metric_df, METRIC_SCHEMA)
+
+
+### SITE MAPPING ###
+
+
+# structure residues are mapped to metric positions by numbering (res_id == position_IMGT)
+# or by aligning the residue sequence to the metric wildtype sequence
+SITE_MAPPING_MODES = ["auto", "numbering", "alignment"]
+# auto mode keeps the numbering if it maps this share of residues at this identity
+SITE_MAP_MIN_COVERAGE = 0.9
+SITE_MAP_MIN_IDENTITY = 0.8
+ALIGN_KMER = 5
+ALIGN_BAND = 16
+ALIGN_SCORES = {"match": 2, "mismatch": -1, "gap": -2}
+SITE_MAP_COLS = ["position_IMGT", "protein_site", "wildtype", "aa_short"]
+
+
+def sequence_get_hash(seq):
+    return hashlib.sha1(seq.encode()).hexdigest()[:16]
+
+
+def pdb_get_sequence(pdb_df):
+    # one letter per residue, skipping residues without a standard amino acid code
+    pdb_df = pdb_df[pdb_df["aa_short"] != "X"]
+    return "".join(pdb_df["aa_short"].astype(str)), list(pdb_df["res_id"].astype(str))
+
+
+def metric_get_sequence(metric_df):
+    # one wildtype letter per position, in site order
+    site_df = metric_df.drop_duplicates(subset=["site"]).sort_values("site")
+    return "".join(site_df["wildtype"].astype(str)), list(site_df["position_IMGT"].astype(str))
+
+
+def sequence_get_diagonal(query, reference, k=ALIGN_KMER):
+    # most common offset (reference index - query index) over shared k-mers
+    kmer_starts = defaultdict(list)
+    for j in range(len(reference) - k + 1):
+        kmer_starts[reference[j:j+k]].append(j)
+    counts = Counter()
+    for i in range(len(query) - k + 1):
+        for j in kmer_starts.get(query[i:i+k], []):
+            counts[j - i] += 1
+    if len(counts) == 0:
+        return None
+    return max(counts, key=lambda x: (counts[x], -abs(x)))
+
+
+def sequence_align_banded(query, reference, diagonal=0, band=ALIGN_BAND, scores=ALIGN_SCORES):
+    # semi-global alignment within band of the diagonal, leading and trailing gaps are free
+    # returns aligned (query index, reference index) pairs, mismatches included
+    n, m = len(query), len(reference)
+    if n == 0 or m == 0:
+        return []
+    gap = scores["gap"]
+    score, trace = {}, {}
+
+    def get_score(i, j):
+        if i == 0 or j == 0:
+            return 0
+        return score.get((i, j), -np.inf)
+
+    for i in range(1, n+1):
+        for j in range(max(1, i + diagonal - band), min(m, i + diagonal + band) + 1):
+            match = (scores["match"] if query[i-1] == reference[j-1] else scores["mismatch"])
+            moves = [get_score(i-1, j-1) + match, get_score(i-1, j) + gap, get_score(i, j-1) + gap]
+            best = int(np.argmax(moves))
+            score[(i, j)] = moves[best]
+            trace[(i, j)] = best
+
+    ends = [(score[(i, j)], i, j) for (i, j) in score if (i == n) or (j == m)]
+    if len(ends) == 0:
+        return []
+    _, i, j = max(ends)
+    pairs = []
+    while (i, j) in trace:
+        move = trace[(i, j)]
+        if move == 0:
+            pairs.append((i-1, j-1))
+            i, j = i-1, j-1
+        elif move == 1:
+            i -= 1
+        else:
+            j -= 1
+    return pairs[::-1]
+
+
+def sequence_align(query, reference, cache_dir=None):
+    # alignments are cached per (query hash, reference hash, alignment parameters hash)
+    cache_path = None
+    if cache_dir is not None:
+        params_hash = sequence_get_hash(json.dumps([ALIGN_KMER, ALIGN_BAND, ALIGN_SCORES], sort_keys=True))
+        cache_path = f"{cache_dir}/{sequence_get_hash(query)}_{sequence_get_hash(reference)}_{params_hash}.json"
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as file:
+                return [tuple(x) for x in json.load(file)["pairs"]]
+
+    diagonal = sequence_get_diagonal(query, reference)
+    if diagonal is None:
+        # no shared k-mers, fall back to the full matrix
+        pairs = sequence_align_banded(query, reference, diagonal=0, band=max(len(query), len(reference)))
+    else:
+        pairs = sequence_align_banded(query, reference, diagonal=diagonal)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, "w") as file:
+            json.dump({"query": query, "reference": reference, "pairs": pairs}, file)
+    return pairs
+
+
+def site_map_by_numbering(pdb_df, metric_df):
+    reference, positions = metric_get_sequence(metric_df)
+    pdb_aa = dict(zip(pdb_df["res_id"].astype(str), pdb_df["aa_short"].astype(str)))
+    rows = [(x, x, wt, pdb_aa[x]) for x, wt in zip(positions, reference) if x in pdb_aa]
+    return pd.DataFrame(rows, columns=SITE_MAP_COLS)
+
+
+def site_map_by_alignment(pdb_df, metric_df, cache_dir=None):
+    query, res_ids = pdb_get_sequence(pdb_df)
+    reference, positions = metric_get_sequence(metric_df)
+    pairs = sequence_align(query, reference, cache_dir=cache_dir)
+    rows = [(positions[j], res_ids[i], reference[j], query[i]) for i, j in pairs]
+    return pd.DataFrame(rows, columns=SITE_MAP_COLS)
+
+
+def site_map_get_stats(site_map_df, pdb_df):
+    # share of standard residues mapped, and wildtype identity over the mapped residues
+    residue_count = max(int((pdb_df["aa_short"] != "X").sum()), 1)
+    coverage = len(site_map_df) / residue_count
+    identity = ((site_map_df["wildtype"] == site_map_df["aa_short"]).mean() if len(site_map_df) > 0 else 0.0)
+    return coverage, identity
+
+
+def site_get_map(pdb_df, metric_df, mode="auto", cache_dir=None):
+    # maps metric positions (position_IMGT) to structure residues (protein_site)
+    if mode not in SITE_MAPPING_MODES:
+        raise Exception(f"ERROR: unknown site mapping mode: {mode} (expected one of {SITE_MAPPING_MODES})")
+    site_map_df = None
+    if mode in ["auto", "numbering"]:
+        site_map_df = site_map_by_numbering(pdb_df, metric_df)
+        coverage, identity = site_map_get_stats(site_map_df, pdb_df)
+        if mode == "auto" and (coverage < SITE_MAP_MIN_COVERAGE or identity < SITE_MAP_MIN_IDENTITY):
+            site_map_df = None
+        else:
+            mode = "numbering"
+    if site_map_df is None:
+        site_map_df = site_map_by_alignment(pdb_df, metric_df, cache_dir=cache_dir)
+        coverage, identity = site_map_get_stats(site_map_df, pdb_df)
+        mode = "alignment"
+
+    _, positions = metric_get_sequence(metric_df)
+    omitted_sites = sorted(set(positions) - set(site_map_df["position_IMGT"]))
+    omitted_residues = sorted(set(pdb_get_sequence(pdb_df)[1]) - set(site_map_df["protein_site"]))
+    print(f"site_map: {mode} mapped={len(site_map_df)} coverage={coverage:.3f} identity={identity:.3f}")
+    if len(omitted_sites) > 0 or len(omitted_residues) > 0:
+        cprint(f"[WARNING] unmapped metric sites: {len(omitted_sites)} {omitted_sites}", color=colors.YELLOW)
+        cprint(f"[WARNING] unmapped structure residues: {len(omitted_residues)} {omitted_residues}", color=colors.YELLOW)
+    return site_map_df
+
+
+def metric_align_sites(metric_df, site_map_df):
+    # prune down to mapped sites and renumber them 1..n in site order
+    # positions are compared as strings, converting only the unique positions
+    metric_positions = {str(x): x for x in metric_df.position_IMGT.unique()}
+    mapped_positions = [metric_positions[x] for x in site_map_df["position_IMGT"] if x in metric_positions]
+    metric_df = metric_df[metric_df.position_IMGT.isin(mapped_positions)].copy()
+    metric_sites = sorted(list(set(metric_df.site)))
+    metric_site_map = {x: y for x, y in zip(metric_sites, range(1, len(metric_sites)+1))}
+    metric_df["site"] = metric_df["site"].map(metric_site_map).astype(metric_df["site"].dtype)
+
+    # the sitemap points each renumbered site to its structure residue
+    protein_sites = dict(zip(site_map_df["position_IMGT"], site_map_df["protein_site"]))
+    site_df = metric_df.drop_duplicates(subset=["site"]).sort_values("site")
     sitemap_df = pd.DataFrame({
-        'sequential_site': range(1, len(protein_sites) + 1),
-        'reference_site': range(1, len(protein_sites) + 1),
-        'protein_site': protein_sites,
+        'sequential_site': range(1, len(site_df) + 1),
+        'reference_site': range(1, len(site_df) + 1),
+        'protein_site': [protein_sites[str(x)] for x in site_df["position_IMGT"]],
     })
-    if site_count:
-        assert len(sitemap_df) >= site_count
-        sitemap_df = sitemap_df[0:site_count].copy()
-
-    if output_path:
-        sitemap_df.to_csv(output_path, index=False)
-    return sitemap_df
+    return metric_df, sitemap_df
 
 
 def write_metric_csv(pdb_df, metric_df, output_path, site_count=None, metric_cols=None):
@@ -165,7 +898,8 @@ def write_metric_csv(pdb_df, metric_df, output_path, site_count=None, metric_col
         metric_df = metric_df[metric_df["condition"].isin(metric_cols)]
 
     if output_path:
-        metric_df.to_csv(output_path, index=False)
+        # chunked ingestion carries extra id columns (annotation), which are not part of the dms-viz input
+        metric_df[METRIC_ID_VARS + ["condition", "factor"]].to_csv(output_path, index=False)
     return metric_df
 
 
@@ -252,250 +986,695 @@ def chainids_get_other_chainids(heavy_chainids=[], light_chainids=[], all_chaini
     return other_chainids
 
 
-### MAIN ###
-
-
-def parse_args(args):
-    arg_parser = argparse.ArgumentParser("gcreplay-viz pipeline")
-    arg_parser.add_argument("--input-dir", type=Parser.parse_input_dir(), help="input directory for pdbs")
-    arg_parser.add_argument("--output-dir", type=Parser.parse_output_dir(), help="output directory for dms-viz jsons")
-    arg_parser.add_argument("--temp-dir", type=Parser.parse_output_dir(), help="temporary directory", default="_temp")
-    arg_parser.add_argument("--chain-id", type=Parser.parse_list(str), help="heavy chain ids", default=["H"])
-    arg_parser.add_argument("--light-chain-id", type=Parser.parse_list(str), help="light chain ids", default=["L"])
-    parser = Parser(arg_parser=arg_parser)
-    args = parser.parse_args()
-    return args
-
-
-def main(args=sys.argv):
-    args = parse_args(args)
-    input_dir = args['input_dir']
-    output_dir = args['output_dir']
-    temp_dir = args['temp_dir']
-    # heavy_chainids = args["chain_id"]
-    # light_chainids = args["light_chain_id"]
-    heavy_chainids = ['H']
-    light_chainids = ['L']
-    focal_chainids = (heavy_chainids + light_chainids)
-    # focal_chainids = (heavy_chainids)
-
-    summary_data = {
-        "dmsviz_filepath": [],
-        "pdb_filepath": [],
-        "pdbid": [],
-        "pdbid_long_name": [],
-        "chainid": [],
-        "chainid_long_name": [],
-        "metric": [],
-        "metric_long_name": [],
-        "description": [],
+### WAREHOUSE ###
+
+
+WAREHOUSE_PARTITION_COLS = ["pdbid", "chainid", "condition"]
+WAREHOUSE_COLS = [
+    "site", "position", "position_IMGT", "wildtype", "mutant", "annotation",
+    "sequential_site", "protein_site", "factor",
+]
+
+
+def metric_get_numeric_conditions(raw_metric_df):
+    # conditions whose raw column holds numbers (bool flags and labels are skipped)
+    conditions = []
+    for col in raw_metric_df.columns:
+        values = raw_metric_df[col]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            conditions.append(col)
+    return conditions
+
+
+def metric_get_annotation_df(raw_metric_df):
+    annotation_df = raw_metric_df[["chain", "position_IMGT", "annotation"]].drop_duplicates(
+        subset=["chain", "position_IMGT"])
+    return df_apply_schema(annotation_df, METRIC_SCHEMA)
+
+
+def warehouse_get_df(pdb_prefix, chainid, metric_df, sitemap_df, annotation_df=None):
+    warehouse_df = metric_df
+    # chunked ingestion already carries the annotation as an id column
+    if "annotation" not in warehouse_df.columns:
+        warehouse_df = warehouse_df.merge(
+            annotation_df,
+            how="left",
+            on=["chain", "position_IMGT"])
+    warehouse_df = warehouse_df.merge(
+        sitemap_df[["reference_site", "sequential_site", "protein_site"]],
+        how="left",
+        left_on="site",
+        right_on="reference_site")
+    warehouse_df["factor"] = pd.to_numeric(warehouse_df["factor"], errors="coerce")
+    warehouse_df["pdbid"] = pdb_prefix
+    warehouse_df["chainid"] = chainid
+    # partition values are written as plain strings
+    warehouse_df["condition"] = warehouse_df["condition"].astype(str)
+    return warehouse_df[WAREHOUSE_PARTITION_COLS + WAREHOUSE_COLS].reset_index(drop=True)
+
+
+def warehouse_write(warehouse_df, warehouse_dir):
+    # Partitions touched by this run are replaced, all other partitions are kept.
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    table = pa.Table.from_pandas(warehouse_df, preserve_index=False)
+    partitioning = ds.partitioning(
+        pa.schema([table.schema.field(col) for col in WAREHOUSE_PARTITION_COLS]),
+        flavor="hive")
+    ds.write_dataset(
+        table,
+        warehouse_dir,
+        format="parquet",
+        partitioning=partitioning,
+        existing_data_behavior="delete_matching")
+    return warehouse_dir
+
+
+def warehouse_read(warehouse_dir, columns=None, filters=None):
+    # filters use the pyarrow DNF form, e.g. [("chainid", "=", "H"), ("annotation", "=", "CDRH3")]
+    return pd.read_parquet(warehouse_dir, engine="pyarrow", columns=columns, filters=filters)
+
+
+### SESSION ###
+
+
+METRIC_NAMES = {
+    "bind": ["bind_CGG"],
+    "expr": ["expr"],
+    "bind_expr": ["bind_CGG", "expr"],
+    "mut_abundance": ["mutation abundance"],
+    "mut_rate": ["mutation rate"],
+    "mut_enrichment": ["mutation enrichment"],
+}
+METRIC_LONG_NAMES = {
+    "bind": "Binding",
+    "expr": "Expression",
+    "bind_expr": "Binding/Expression",
+    "delta": "Binding/Expression: Delta Change Relative to Wildtype",
+    "mut_abundance": "Mutation Abundance",
+    "mut_rate": "Mutation Rate",
+    "mut_enrichment": "Mutation Enrichment",
+}
+CHAIN_LONG_NAMES = {
+    "H": "Heavy Chain",
+    "L": "Light Chain",
+}
+SUMMARY_FIELDS = [
+    "dmsviz_filepath",
+    "pdb_filepath",
+    "pdbid",
+    "pdbid_long_name",
+    "chainid",
+    "chainid_long_name",
+    "metric",
+    "metric_long_name",
+    "region",
+    "region_long_name",
+    "description",
+    "summary_stats",
+]
+# whole-chain datasets are listed under this region
+REGION_ALL = "ALL"
+REGION_ALL_LONG_NAME = "All Regions"
+SUMMARY_STATS = ["mean", "min", "max", "sum", "median"]
+# significant digits of published stats, float32 holds about 7
+SUMMARY_STATS_DIGITS = 7
+METRIC_FINAL_NAME = "all_metrics"
+METRIC_FINAL_LONG_NAME = "All Metrics"
+
+
+def format_number_for_lex_sort(value, int_digits=5, decimal_digits=2, num_pref_zeroes=0):
+    abs_value = abs(value)
+    total_width = int_digits + 1 + decimal_digits  # 1 for decimal point
+    pref_zeroes = "0" * num_pref_zeroes
+    # sign = '+' if value >= 0 else '-'
+    sign = '0' if value >= 0 else '-'
+    return f"{sign}{pref_zeroes}{abs_value:0{total_width}.{decimal_digits}f}"
+
+
+def metric_get_stats(metric_df, by=["condition", "site"]):
+    # all summary stats for every group in a single grouped pass
+    # accumulate in float64, values may be stored as float32
+    factor = pd.to_numeric(metric_df["factor"], errors="coerce").astype("float64")
+    grouped = factor.groupby([metric_df[col] for col in by], sort=True, observed=True)
+    stats_df = grouped.agg(["count"] + SUMMARY_STATS).reset_index()
+    return stats_df
+
+
+def stats_get_value(value, stat=None):
+    # NaN as None so it serializes to json null, counts as int, and the rest rounded to the precision of the float32 factors
+    if pd.isna(value):
+        return None
+    if stat == "count":
+        return int(value)
+    return float(f"{value:.{SUMMARY_STATS_DIGITS}g}")
+
+
+def stats_get_condition_dict(condition_stats_df):
+    # {condition: {stat: value}}
+    condition_stats = {}
+    for row in condition_stats_df.to_dict(orient="records"):
+        condition_stats[row["condition"]] = {
+            stat: stats_get_value(row[stat], stat) for stat in ["count"] + SUMMARY_STATS}
+    return condition_stats
+
+
+def stats_get_site_dict(site_stats_df):
+    # {condition: {"site": [...], stat: [...]}}, columnar to keep the json compact
+    site_stats = {}
+    for condition, condition_df in site_stats_df.groupby("condition", sort=False, observed=True):
+        site_stats[condition] = {"site": [int(x) for x in condition_df["site"]]}
+        for stat in ["count"] + SUMMARY_STATS:
+            site_stats[condition][stat] = [stats_get_value(x, stat) for x in condition_df[stat]]
+    return site_stats
+
+
+def metric_get_heatmap_options(metric_df=None, condition_stats_df=None):
+    # overall limits are combined from per-condition stats when given, rather than rescanning the metric values
+    if condition_stats_df is None:
+        condition_stats_df = metric_get_stats(metric_df, by=["condition"])
+    stats = {
+        "min": condition_stats_df["min"].min(),
+        "mean": condition_stats_df["sum"].sum() / condition_stats_df["count"].sum(),
+        "max": condition_stats_df["max"].max(),
     }
 
-    aa_seqs = {}
-    all_chainids = []
-    other_chainids = []
+    # This is a workaround for a heatmap bug: configure-dms-viz parses these numeric values lexicographically.
+    # The program requires min < mean < max, lexicographically.
+    heatmap = {}
+    heatmap["min"] = format_number_for_lex_sort(stats["min"] - 0.01)
+    heatmap["mean"] = format_number_for_lex_sort(stats["mean"])
+    heatmap["max"] = format_number_for_lex_sort(stats["max"] + 0.01)
+
+    if not (heatmap['min'] < heatmap['max']):
+        # raise Exception(f"mean not less than max by lex_sort: {heatmap['mean']=} {heatmap['max']=}")
+        return f"--heatmap-limits {heatmap['mean']}"
+    if not ((heatmap['min'] < heatmap['mean']) and (heatmap['mean'] < heatmap['max'])):
+        # raise Exception(f"min not less than mean by lex_sort: {heatmap['min']=} {heatmap['mean']=}")
+        return f"--heatmap-limits {heatmap['min']},{heatmap['max']}"
+    return f"--heatmap-limits {heatmap['min']},{heatmap['mean']},{heatmap['max']}"
+
+
+def dmsviz_add_stats(dmsviz_path, site_stats, condition_stats):
+    # embed precomputed aggregates into each dataset of a dms-viz json
+    with open(dmsviz_path, "r") as file:
+        dmsviz_data = json.load(file)
+    for dataset in dmsviz_data.values():
+        dataset["site_summary_stats"] = site_stats
+        dataset["condition_summary_stats"] = condition_stats
+    with open(dmsviz_path, "w") as file:
+        json.dump(dmsviz_data, file)
+    return dmsviz_path
+
+
+def pdb_get_prefix(pdb_path):
+    return os.path.basename(pdb_path).split(".")[0]
+
+
+def dataset_get_name(pdb_prefix, chainid, metric_name, region=None):
+    if region is None:
+        return f"{pdb_prefix}.{chainid}.{metric_name}"
+    return f"{pdb_prefix}.{chainid}.{metric_name}.{region}"
+
+
+def metric_get_regions(annotation_df, chainid):
+    # {region: [position_IMGT, ...]} for one chain, with regions in position order
+    annotation_df = annotation_df[annotation_df["chain"] == chainid]
+    annotation_df = annotation_df.drop_duplicates(subset=["position_IMGT"]).sort_values("position_IMGT")
+    regions = {}
+    for position, region in zip(annotation_df["position_IMGT"], annotation_df["annotation"]):
+        if pd.isna(region):
+            continue
+        regions.setdefault(str(region), []).append(str(position))
+    return regions
+
+
+### PLAN ###
+
+
+# serialized size of one metric value in a dms-viz json, measured on CGG outputs
+PLAN_BYTES_PER_VALUE = 96
+PLAN_SAMPLE_BYTES = 2**16
+PLAN_STATUSES = ["cached", "stale", "missing"]
+# parameters of the last completed run, so outputs of a run with other parameters are not reported as cached
+RUN_PARAMS_NAME = "run_params.json"
+
+
+def structure_scan_chainids(pdb_path):
+    # chain ids from the ATOM/HETATM records, without parsing the structure
+    # mmCIF/BinaryCIF chains are only known after parsing, so None is returned
+    if structure_is_cif(pdb_path):
+        return None
+    chainids = {}
+    with open(pdb_path, "r") as file:
+        for line in file:
+            if line.startswith(("ATOM", "HETATM")) and len(line) > 21:
+                chainids[line[21]] = None
+    return list(chainids)
+
+
+def metric_estimate_rows(metric_path, sample_bytes=PLAN_SAMPLE_BYTES):
+    # row count from the mean line length at the head of the file
+    size = os.path.getsize(metric_path)
+    with open(metric_path, "rb") as file:
+        sample = file.read(sample_bytes)
+    line_count = sample.count(b"\n")
+    if line_count == 0 or len(sample) == size:
+        return max(line_count - 1, 0)
+    return int(size / (len(sample) / line_count)) - 1
+
+
+def plan_get_job(kind, output_path, input_paths, est_bytes, input_jobs=[], params_match=True, **fields):
+    # a job is cached if its output is newer than all of its inputs, all input jobs are cached,
+    # and it was written by a run with the same parameters
+    input_paths = list(input_paths) + [job["output_path"] for job in input_jobs]
+    if not os.path.exists(output_path):
+        status = "missing"
+    elif not params_match:
+        status = "stale"
+    elif any(job["status"] != "cached" for job in input_jobs):
+        status = "stale"
+    elif any(os.path.getmtime(x) > os.path.getmtime(output_path) for x in input_paths if os.path.exists(x)):
+        status = "stale"
+    else:
+        status = "cached"
+    is_cached = (status == "cached")
+    return {
+        "kind": kind,
+        **fields,
+        "output_path": output_path,
+        "status": status,
+        "size": (os.path.getsize(output_path) if is_cached else int(est_bytes)),
+        "estimated": not is_cached,
+        "inputs": input_paths,
+    }
 
-    # load pdb files
-    input_pdb_paths = glob.glob(f"{input_dir}/*.pdb")
-    print(input_pdb_paths)
 
-    # get all chain ids
-    for input_pdb_path in input_pdb_paths:
-        all_chainids += pdb_get_chainids(pdb_path=input_pdb_path)
-    # other chainids include chainids not in heavy or light chain
-    all_chainids = list(set(all_chainids))
-    print(f"all_chainids: {all_chainids}")
-    for chainid in all_chainids:
-        aa_seqs[chainid] = []
-
-    # get all pdbs
-    all_pdb_dfs = {}
-    for pdb_path in input_pdb_paths:
-        for chainid in all_chainids:
-            pdb_df = pdb_get_df(
-                pdb_path=pdb_path,
-                chainids=chainid)
-            if len(pdb_df) > 0:
-                all_pdb_dfs[tuple([pdb_path, chainid])] = pdb_df
-
-            aa_seq = ''.join(list(pdb_df['aa_short']))
-            # print(f"aa_seq: {len(aa_seq)} {aa_seq}")
+def format_bytes(size):
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def plan_print(jobs):
+    counts = {status: sum(job["status"] == status for job in jobs) for status in PLAN_STATUSES}
+    kinds = {kind: sum(job["kind"] == kind for job in jobs) for kind in ["format", "join"]}
+    total_size = sum(job["size"] for job in jobs if job["status"] != "cached")
+    cprint(f"[PLAN] {len(jobs)} jobs: {kinds['format']} format, {kinds['join']} join", color=colors.GREEN)
+    cprint(f"[PLAN] {' '.join(f'{k}={v}' for k, v in counts.items())} | to write: ~{format_bytes(total_size)}", color=colors.GREEN)
+    print(f"{'status':<8} {'kind':<6} {'size':>11}  output")
+    for job in jobs:
+        size_str = ("~" if job["estimated"] else "") + format_bytes(job["size"])
+        print(f"{job['status']:<8} {job['kind']:<6} {size_str:>11}  {job['output_path']}")
+
+
+class PipelineSession:
+    # Loads structures and metric tables once and caches parsed and aligned state,
+    # so single datasets can be built from a notebook or service without a full run.
+
+    def __init__(self, input_dir=None, temp_dir="_temp",
+                 heavy_chainids=["H"], light_chainids=["L"],
+                 pdb_paths=None, metric_path=None,
+                 metric_names=METRIC_NAMES, metric_long_names=METRIC_LONG_NAMES,
+                 chain_long_names=CHAIN_LONG_NAMES, warehouse_dir=None,
+                 targets=None, chunksize=None, derived_metrics=None,
+                 site_mapping="auto", regions=False):
+        self.input_dir = input_dir
+        self.temp_dir = temp_dir
+        self.site_mapping = site_mapping
+        # if set, datasets are also partitioned by annotation region (FWR/CDR)
+        self.regions = regions
+        # sequence alignments are cached across runs
+        self.alignment_cache_dir = f"{temp_dir}/alignment_cache"
+        self.warehouse_dir = warehouse_dir
+        self.targets = targets
+        # if set, the metric table is streamed in chunks of this many rows
+        self.chunksize = chunksize
+        self.heavy_chainids = list(heavy_chainids)
+        self.light_chainids = list(light_chainids)
+        self.focal_chainids = (self.heavy_chainids + self.light_chainids)
+        self.metric_names = dict(metric_names)
+        self.metric_long_names = dict(metric_long_names)
+        self.chain_long_names = dict(chain_long_names)
+        # derived metrics are registered as metric groups of their own
+        self.derived_metrics = dict(derived_metrics or {})
+        for name, spec in self.derived_metrics.items():
+            self.metric_names[name] = [derived_get_condition(spec)]
+            self.metric_long_names[name] = derived_get_long_name(spec)
+
+        if pdb_paths is None:
+            pdb_paths = structure_get_paths(input_dir)
+        if metric_path is None:
+            metric_path = sorted(glob.glob(f"{input_dir}/*.csv"))[0]
+        self.pdb_paths = list(pdb_paths)
+        self.metric_path = metric_path
+
+        # cached state
+        self.all_chainids = None
+        self.raw_metric_df = None
+        self.spill_paths = None
+        self.pdb_dfs = {}
+        self.metric_dfs = {}
+        self.site_maps = {}
+        self.chain_regions = {}
+        self.structure_text_paths = {}
+        self.aligned = {}
+        self.dataset_paths = {}
+        self.dataset_stats = {}
+        self.dataset_frames = {}
+        self.summary_data = {field: [] for field in SUMMARY_FIELDS}
+
+    # ** loading
+
+    def load_structures(self):
+        if self.all_chainids is not None:
+            return self.pdb_dfs
+        all_chainids = []
+        for pdb_path in self.pdb_paths:
+            # parse each structure once and split by chain
+            pdb_df = pdb_get_df(pdb_path=pdb_path)
+            for chainid, chain_df in pdb_df.groupby("chainid", sort=False, observed=True):
+                self.pdb_dfs[(pdb_path, chainid)] = chain_df.reset_index(drop=True)
+                all_chainids.append(chainid)
+        # other chainids include chainids not in heavy or light chain
+        self.all_chainids = sorted(set(all_chainids))
+        print(f"all_chainids: {self.all_chainids}")
+        return self.pdb_dfs
+
+    def load_metrics(self):
+        if self.raw_metric_df is None:
+            # in chunked mode only a sample is kept in memory, for column names and types
+            self.raw_metric_df = metric_read_csv(self.metric_path, nrows=self.chunksize)
+            if not self.chunksize:
+                # derived totals are taken over the selected targets only, as in chunked mode
+                if (self.targets is not None) and ("target" in self.raw_metric_df.columns):
+                    self.raw_metric_df = self.raw_metric_df[self.raw_metric_df["target"].isin(self.targets)]
+                self.raw_metric_df = metric_add_derived(self.raw_metric_df, self.derived_metrics)
+            print(f"metric_columns: {self.raw_metric_df.columns}")
+        return self.raw_metric_df
+
+    def load(self):
+        self.load_structures()
+        self.load_metrics()
+        return self
+
+    def get_pdb_df(self, pdb_path, chainid):
+        self.load_structures()
+        return self.pdb_dfs[(pdb_path, chainid)]
+
+    def get_metric_df(self, chainid):
+        if chainid in self.metric_dfs:
+            return self.metric_dfs[chainid]
+        if self.chunksize:
+            self.metric_dfs[chainid] = metric_read_spill(self.load_metric_spill(), chainid)
+        else:
+            self.metric_dfs[chainid] = metric_get_binding_df(
+                pdb_df=None,
+                metric_path=self.metric_path,
+                chainids=[chainid],
+                metric_names=None,
+                raw_metric_df=self.load_metrics(),
+                targets=self.targets)
+        return self.metric_dfs[chainid]
+
+    def load_metric_spill(self):
+        if self.spill_paths is None:
+            # the warehouse needs every condition, otherwise only those used by the metric groups
+            metric_names = None
+            if self.warehouse_dir is None:
+                metric_names = sorted(set(sum(self.metric_names.values(), [])))
+            derived_totals = None
+            if self.derived_metrics:
+                derived_totals = derived_get_totals_chunked(
+                    metric_path=self.metric_path,
+                    derived_metrics=self.derived_metrics,
+                    chainids=self.focal_chainids,
+                    targets=self.targets,
+                    chunksize=self.chunksize)
+            self.spill_paths = metric_get_binding_df_chunked(
+                metric_path=self.metric_path,
+                spill_dir=f"{self.temp_dir}/metric_spill",
+                chainids=self.focal_chainids,
+                metric_names=metric_names,
+                targets=self.targets,
+                chunksize=self.chunksize,
+                derived_metrics=self.derived_metrics,
+                derived_totals=derived_totals)
+        return self.spill_paths
+
+    def get_aa_seqs(self):
+        self.load_structures()
+        aa_seqs = {chainid: [] for chainid in self.all_chainids}
+        for (pdb_path, chainid), pdb_df in self.pdb_dfs.items():
+            aa_seqs[chainid].append(''.join(list(pdb_df['aa_short'])))
+        for chainid in aa_seqs:
+            metric_df = self.get_metric_df(chainid)
+            aa_seq = ''.join(list(metric_df.drop_duplicates(subset=["position"])['wildtype']))
             if len(aa_seq) > 0:
                 aa_seqs[chainid].append(aa_seq)
-
-    # get first pdb_df from file
-    first_key = next(iter(all_pdb_dfs))
-    pdb_df = all_pdb_dfs[first_key]
-
-    # parse metric files
-    input_metric_paths = glob.glob(f"{input_dir}/*.csv")
-    input_metric_path = input_metric_paths[0]
-    raw_metric_df = pd.read_csv(input_metric_path)
-    print(f"metric_columns: {raw_metric_df.columns}")
-
-    metric_names = {
-        "bind": ["bind_CGG"],
-        "expr": ["expr"],
-        "bind_expr": ["bind_CGG", "expr"],
-        "mut_abundance": ["mutation abundance"],
-        "mut_rate": ["mutation rate"],
-        "mut_enrichment": ["mutation enrichment"],
-    }
-    metric_long_names = {
-        "bind": "Binding",
-        "expr": "Expression",
-        "bind_expr": "Binding/Expression",
-        "delta": "Binding/Expression: Delta Change Relative to Wildtype",
-        "mut_abundance": "Mutation Abundance",
-        "mut_rate": "Mutation Rate",
-        "mut_enrichment": "Mutation Enrichment",
-    }
-    chain_long_names = {
-        "H": "Heavy Chain",
-        "L": "Light Chain",
-    }
-
-    all_metric_dfs = {}
-    for (pdb_path, chainid), pdb_df in all_pdb_dfs.items():
-        metric_df = metric_get_binding_df(
-                    pdb_df=pdb_df,
-                    metric_path=input_metric_path,
-                    chainids=[chainid],
-                    metric_names=None)
-        if len(metric_df) > 0:
-            all_metric_dfs[chainid] = metric_df
-
-        tmp_metric_df = metric_df.drop_duplicates(subset=["position"])
-        aa_seq = ''.join(list(tmp_metric_df['wildtype']))
-        # print(f"aa_seq: {chainid} {len(aa_seq)} {aa_seq}")
-        if len(aa_seq) > 0:
-            aa_seqs[chainid].append(aa_seq)
-
-    pprint.pp(aa_seqs)
-    # compare_seqs(aa_seqs=aa_seqs)
-
-    all_dmsviz_paths = []
-
-    # build csvs and dmsviz jsons
-    for (pdb_path, chainid), pdb_df in all_pdb_dfs.items():
-        pdb_prefix = os.path.basename(pdb_path).split(".")[0]
-        # pdb_prefix = "CGG_naive_DMS"
-        chain_str = f"{''.join(chainid)}"
+        return aa_seqs
+
+    def get_other_chainids(self):
+        self.load_structures()
+        return chainids_get_other_chainids(
+            heavy_chainids=self.heavy_chainids,
+            light_chainids=self.light_chainids,
+            all_chainids=self.all_chainids)
+
+    def get_structure_text_path(self, pdb_path):
+        if pdb_path not in self.structure_text_paths:
+            self.structure_text_paths[pdb_path] = structure_get_text_path(pdb_path, self.temp_dir)
+        return self.structure_text_paths[pdb_path]
+
+    # ** alignment
+
+    def get_site_map(self, pdb_path, chainid, region=None):
+        key = (pdb_path, chainid)
+        if key not in self.site_maps:
+            self.site_maps[key] = site_get_map(
+                pdb_df=self.get_pdb_df(pdb_path, chainid),
+                metric_df=self.get_metric_df(chainid),
+                mode=self.site_mapping,
+                cache_dir=self.alignment_cache_dir)
+        site_map_df = self.site_maps[key]
+        if region is not None:
+            chain_regions = self.get_chain_regions(chainid)
+            if region not in chain_regions:
+                raise Exception(f"ERROR: unknown region '{region}' for chain {chainid} (expected one of {list(chain_regions)})")
+            positions = chain_regions[region]
+            site_map_df = site_map_df[site_map_df["position_IMGT"].isin(positions)]
+        return site_map_df
+
+    def get_chain_regions(self, chainid):
+        if chainid not in self.chain_regions:
+            metric_df = self.get_metric_df(chainid)
+            # chunked ingestion already carries the annotation as an id column
+            if "annotation" in metric_df.columns:
+                annotation_df = metric_df[["chain", "position_IMGT", "annotation"]]
+            else:
+                annotation_df = metric_get_annotation_df(self.load_metrics())
+            self.chain_regions[chainid] = metric_get_regions(annotation_df, chainid)
+        return self.chain_regions[chainid]
+
+    def get_regions(self, pdb_path, chainid):
+        # regions with at least one site mapped onto the structure
+        mapped_positions = set(self.get_site_map(pdb_path, chainid)["position_IMGT"])
+        return [region for region, positions in self.get_chain_regions(chainid).items()
+                if len(mapped_positions.intersection(positions)) > 0]
+
+    def align(self, pdb_path, chainid, metric_name, region=None):
+        key = (pdb_path, chainid, metric_name)
+        if region is not None:
+            key += (region,)
+        if key in self.aligned:
+            return self.aligned[key]
+        metric_cols = self.metric_names[metric_name]
+        metric_df = self.get_metric_df(chainid)
+        metric_df = metric_df[metric_df["condition"].isin(metric_cols)]
+        metric_df, sitemap_df = metric_align_sites(metric_df=metric_df, site_map_df=self.get_site_map(pdb_path, chainid, region))
+        self.aligned[key] = (sitemap_df, metric_df)
+        return self.aligned[key]
+
+    def align_all(self, pdb_path, chainid):
+        # aligned metric rows over every numeric condition
+        key = (pdb_path, chainid, None)
+        if key in self.aligned:
+            return self.aligned[key]
+        conditions = metric_get_numeric_conditions(self.load_metrics())
+        # in chunked mode the derived columns are only present in the spilled partitions
+        conditions += [x for x in derived_get_conditions(self.derived_metrics) if x not in conditions]
+        metric_df = self.get_metric_df(chainid)
+        metric_df = metric_df[metric_df["condition"].isin(conditions)]
+        metric_df, sitemap_df = metric_align_sites(metric_df=metric_df, site_map_df=self.get_site_map(pdb_path, chainid))
+        self.aligned[key] = (sitemap_df, metric_df)
+        return self.aligned[key]
+
+    # ** warehouse
+
+    def get_warehouse_df(self, pdb_path, chainid):
+        sitemap_df, metric_df = self.align_all(pdb_path, chainid)
+        return warehouse_get_df(
+            pdb_prefix=pdb_get_prefix(pdb_path),
+            chainid=chainid,
+            metric_df=metric_df,
+            sitemap_df=sitemap_df,
+            annotation_df=(None if self.chunksize else metric_get_annotation_df(self.load_metrics())))
+
+    def write_warehouse(self, warehouse_dir=None):
+        warehouse_dir = warehouse_dir or self.warehouse_dir
+        warehouse_dfs = []
+        for (pdb_path, chainid) in self.load_structures():
+            if chainid not in self.focal_chainids:
+                continue
+            warehouse_dfs.append(self.get_warehouse_df(pdb_path, chainid))
+        if len(warehouse_dfs) == 0:
+            return None
+        warehouse_df = pd.concat(warehouse_dfs, ignore_index=True)
+        warehouse_write(warehouse_df, warehouse_dir)
+        cprint(f"[SUCCESS] wrote {len(warehouse_df)} rows to warehouse: {warehouse_dir}", color=colors.GREEN)
+        return warehouse_dir
+
+    # ** datasets
+
+    def get_description(self, pdb_path, chainid, metric_name, region=None):
+        metric_long_name = self.metric_long_names.get(metric_name, metric_name)
+        if metric_name == METRIC_FINAL_NAME:
+            metric_long_name = METRIC_FINAL_LONG_NAME
+        description = f"{pdb_get_prefix(pdb_path)} :: {chainid} :: {metric_long_name}"
+        if region is not None:
+            description += f" :: {region}"
+        return description
+
+    def build_dataset(self, pdb_path, chainid, metric_name, output_path=None, region=None):
+        # Returns the dms-viz json as a dict, or writes it to `output_path` and returns the path.
+        # If `region` is given, only the sites annotated with that region are included.
+        pdb_prefix = pdb_get_prefix(pdb_path)
+        dataset_name = dataset_get_name(pdb_prefix, chainid, metric_name, region)
+        sitemap_df, metric_df = self.align(pdb_path, chainid, metric_name, region)
+        metric_cols = self.metric_names[metric_name]
+
+        # build sitemap and metric csvs
+        os.makedirs(self.temp_dir, exist_ok=True)
+        sitemap_name = (f"{pdb_prefix}.{chainid}" if region is None else f"{pdb_prefix}.{chainid}.{region}")
+        sitemap_path = f"{self.temp_dir}/{sitemap_name}.sitemap.csv"
+        sitemap_df.to_csv(sitemap_path, index=False)
+        metric_path = f"{self.temp_dir}/{dataset_name}.csv"
+        metric_df = write_metric_csv(
+            pdb_df=None,
+            metric_df=metric_df,
+            output_path=metric_path,
+            metric_cols=metric_cols,)
+        num_metrics = len(set(metric_df["condition"]))
+        site_stats_df = metric_get_stats(metric_df, by=["condition", "site"])
+        condition_stats_df = metric_get_stats(metric_df, by=["condition"])
+
+        add_options = ""
+        add_options += '--condition "condition" '
+        add_options += '--condition-name "Metric" '
+        add_options += metric_get_heatmap_options(condition_stats_df=condition_stats_df)
+
+        dmsviz_path = output_path
+        if dmsviz_path is None:
+            dmsviz_path = f"{self.temp_dir}/{dataset_name}.dmsviz.json"
+        dmsviz_format(
+            name=self.get_description(pdb_path, chainid, metric_name, region),
+            plot_colors=ALT_PALETTE[:num_metrics],
+            metric="factor",
+            input_metric_path=metric_path,
+            input_sitemap_path=sitemap_path,
+            output_path=dmsviz_path,
+            included_chains=[chainid],
+            excluded_chains=self.get_other_chainids(),
+            add_options=add_options,
+            local_pdb_path=self.get_structure_text_path(pdb_path))
+        condition_stats = stats_get_condition_dict(condition_stats_df)
+        dmsviz_add_stats(dmsviz_path, stats_get_site_dict(site_stats_df), condition_stats)
+        self.dataset_paths[(pdb_path, chainid, metric_name) + (() if region is None else (region,))] = dmsviz_path
+        self.dataset_stats[dmsviz_path] = condition_stats
+        self.dataset_frames[dmsviz_path] = metric_df
+
+        if output_path is None:
+            with open(dmsviz_path, "r") as file:
+                return json.load(file)
+        return output_path
+
+    def join_datasets(self, input_paths, output_path=None, description=None):
+        # Returns the joined dms-viz json as a dict, or writes it to `output_path` and returns the path.
+        dmsviz_path = output_path
+        if dmsviz_path is None:
+            dmsviz_path = f"{self.temp_dir}/_joined.dmsviz.json"
+        dmsviz_join(
+            input_paths=input_paths,
+            output_path=dmsviz_path,
+            description=description)
+        # the joined stats are recomputed over the rows of all inputs, since the same condition
+        # appears in several metric groups and, when joining chains, once per chain
+        metric_dfs = [self.dataset_frames[x] for x in input_paths if x in self.dataset_frames]
+        self.dataset_stats[dmsviz_path] = {}
+        if len(metric_dfs) > 0:
+            metric_df = pd.concat(metric_dfs, ignore_index=True)
+            metric_df = metric_df.drop_duplicates(subset=["chain", "position_IMGT", "mutant", "condition"])
+            self.dataset_frames[dmsviz_path] = metric_df
+            self.dataset_stats[dmsviz_path] = stats_get_condition_dict(metric_get_stats(metric_df, by=["condition"]))
+
+        if output_path is None:
+            with open(dmsviz_path, "r") as file:
+                return json.load(file)
+        return output_path
+
+    # ** full run
+
+    def add_summary_entry(self, dmsviz_path, pdb_path, chainid, chainid_long_name, metric_name, metric_long_name, description,
+                          region=REGION_ALL, region_long_name=REGION_ALL_LONG_NAME):
+        pdb_prefix = pdb_get_prefix(pdb_path)
+        self.summary_data["dmsviz_filepath"].append(os.path.basename(dmsviz_path))
+        self.summary_data["pdb_filepath"].append(os.path.basename(pdb_path))
+        self.summary_data["pdbid"].append(pdb_prefix)
+        self.summary_data["pdbid_long_name"].append(pdb_prefix)
+        self.summary_data["chainid"].append(chainid)
+        self.summary_data["chainid_long_name"].append(chainid_long_name)
+        self.summary_data["metric"].append(metric_name)
+        self.summary_data["metric_long_name"].append(metric_long_name)
+        self.summary_data["region"].append(region)
+        self.summary_data["region_long_name"].append(region_long_name)
+        self.summary_data["description"].append(description)
+        self.summary_data["summary_stats"].append(self.dataset_stats.get(dmsviz_path, {}))
+
+    def run_chain(self, pdb_path, chainid):
+        pdb_prefix = pdb_get_prefix(pdb_path)
         print(f"pdb: {pdb_prefix=} {chainid=}")
+        dmsviz_paths = self.run_region(pdb_path, chainid)
+        if self.regions:
+            for region in self.get_regions(pdb_path, chainid):
+                print(f"region: {region=}")
+                self.run_region(pdb_path, chainid, region=region)
+        # only whole-chain datasets are joined across chains
+        return dmsviz_paths
+
+    def run_region(self, pdb_path, chainid, region=None):
+        pdb_prefix = pdb_get_prefix(pdb_path)
+        chainid_long_name = self.chain_long_names.get(chainid, chainid)
+        region_fields = {}
+        if region is not None:
+            region_fields = {"region": region, "region_long_name": region}
 
         dmsviz_paths = []
-
-        # skip if not in focal_chainids
-        if chainid not in focal_chainids:
-            continue
-        other_chainids = chainids_get_other_chainids(
-            heavy_chainids=heavy_chainids, light_chainids=light_chainids, all_chainids=all_chainids)
-
-        for metric_name, metric_cols in metric_names.items():
-            print(f"metric: {metric_name=} {metric_cols=}")
-            metric_long_name = metric_long_names[metric_name]
-            metric_df = all_metric_dfs[chainid]
-
-            # get number of metrics
-            metric_df = metric_df[metric_df["condition"].isin(metric_cols)]
-            metric_types = set(metric_df["condition"])
-            num_metrics = len(metric_types)
-            print(f"{metric_types=}")
-
-            # prune down to only common IMGT sites
-            # if only_common_sites:
-            pdb_sites = set(pdb_df.res_id.astype(str))
-            metric_sites = set(metric_df.position_IMGT.astype(str))
-            union_sites = pdb_sites & metric_sites
-            metric_only_sites = metric_sites - pdb_sites
-            print(f"metric_only_sites = {sorted(list(metric_only_sites))}")
-            pdb_only_sites = pdb_sites - metric_sites
-            print(f"pdb_only_sites = {sorted(list(pdb_only_sites))}")
-            xor_sites = pdb_sites ^ metric_sites
-            metric_df = metric_df[metric_df.position_IMGT.astype(str).isin(union_sites)]
-            print(f"omitted_sites: {len(xor_sites)} {sorted(list(xor_sites))}")
-            metric_sites = sorted(list(set(metric_df.site)))
-            metric_site_map = {x: y for x, y in zip(metric_sites, range(1, len(metric_sites)+1))}
-            metric_df["site"] = [metric_site_map[x] for x in metric_df["site"]]
-
-            # build sitemap csv
-            sitemap_path = f"{temp_dir}/{pdb_prefix}.{chain_str}.sitemap.csv"
-            sitemap_df = write_sitemap_csv(
-                pdb_df=pdb_df,
-                output_path=sitemap_path)
-
-            # build metric csv
-            metric_path = f"{temp_dir}/{pdb_prefix}.{chain_str}.{metric_name}.csv"
-            metric_df = write_metric_csv(
-                pdb_df=pdb_df,
-                metric_df=metric_df,
-                output_path=metric_path,
-                metric_cols=metric_cols,)
-
-            add_options = ""
-            condition_options = '--condition "condition" '
-            condition_options += '--condition-name "Metric" '
-            add_options += condition_options
-
-            def format_number_for_lex_sort(value, int_digits=5, decimal_digits=2, num_pref_zeroes=0):
-                abs_value = abs(value)
-                total_width = int_digits + 1 + decimal_digits  # 1 for decimal point
-                pref_zeroes = "0" * num_pref_zeroes
-                # sign = '+' if value >= 0 else '-'
-                sign = '0' if value >= 0 else '-'
-                return f"{sign}{pref_zeroes}{abs_value:0{total_width}.{decimal_digits}f}"
-
-            # This is a workaround for a heatmap bug: configure-dms-viz parses these numeric values lexicographically.
-            # The program requires min < mean < max, lexicographically.
-            heatmap = {}
-            heatmap["min"] = format_number_for_lex_sort(metric_df["factor"].min() - 0.01)
-            heatmap["mean"] = format_number_for_lex_sort(metric_df["factor"].mean())
-            heatmap["max"] = format_number_for_lex_sort(metric_df["factor"].max() + 0.01)
-
-            if not (heatmap['min'] < heatmap['max']):
-                # raise Exception(f"mean not less than max by lex_sort: {heatmap['mean']=} {heatmap['max']=}")
-                heatmap_limit_options = f"--heatmap-limits {heatmap['mean']}"
-            if not ((heatmap['min'] < heatmap['mean']) and (heatmap['mean'] < heatmap['max'])):
-                # raise Exception(f"min not less than mean by lex_sort: {heatmap['min']=} {heatmap['mean']=}")
-                heatmap_limit_options = f"--heatmap-limits {heatmap['min']},{heatmap['max']}"
-            else:
-                heatmap_limit_options = f"--heatmap-limits {heatmap['min']},{heatmap['mean']},{heatmap['max']}"
-            add_options += heatmap_limit_options
-
+        for metric_name in self.metric_names:
+            print(f"metric: {metric_name=} {self.metric_names[metric_name]=}")
+            dmsviz_path = f"{self.temp_dir}/{dataset_get_name(pdb_prefix, chainid, metric_name, region)}.dmsviz.json"
             try:
-                # build dms-viz json
-                description = f"{pdb_prefix} :: {chain_str} :: {metric_long_name}"
-                dmsviz_path = f"{temp_dir}/{pdb_prefix}.{chain_str}.{metric_name}.dmsviz.json"
-                # COLOR_PALETTE = generate_color_palette(
-                #     n_colors=num_metrics, colormap=COLOR_MAP, as_hex=True)
-                COLOR_PALETTE=ALT_PALETTE[:num_metrics]
-                dmsviz_format(
-                    name=description,
-                    plot_colors=COLOR_PALETTE,
-                    metric="factor",
-                    input_metric_path=metric_path,
-                    input_sitemap_path=sitemap_path,
-                    output_path=dmsviz_path,
-                    included_chains=chainid,
-                    excluded_chains=other_chainids,
-                    add_options=add_options,
-                    local_pdb_path=input_pdb_path)
+                self.build_dataset(pdb_path, chainid, metric_name, output_path=dmsviz_path, region=region)
                 dmsviz_paths.append(dmsviz_path)
-                all_dmsviz_paths.append(dmsviz_path)
-
-                # add summary data entry
-                summary_data["dmsviz_filepath"].append(os.path.basename(dmsviz_path))
-                summary_data["pdb_filepath"].append(os.path.basename(pdb_path))
-                summary_data["pdbid"].append(pdb_prefix)
-                summary_data["pdbid_long_name"].append(pdb_prefix)
-                summary_data["chainid"].append(chain_str)
-                summary_data["chainid_long_name"].append(chain_long_names[chainid])
-                summary_data["metric"].append(metric_name)
-                summary_data["metric_long_name"].append(metric_long_name)
-                summary_data["description"].append(description)
-
+                self.add_summary_entry(
+                    dmsviz_path, pdb_path, chainid, chainid_long_name,
+                    metric_name, self.metric_long_names.get(metric_name, metric_name),
+                    self.get_description(pdb_path, chainid, metric_name, region),
+                    **region_fields)
             except Exception as e:
-                cprint(f"[ERROR] {pdb_prefix} {chainid} {metric_name}", color=colors.RED)
+                cprint(f"[ERROR] {pdb_prefix} {chainid} {metric_name} {region or ''}", color=colors.RED)
                 cprint(f"[ERROR] error occurred during `configure-dms-viz format`: {e}", color=colors.RED)
                 if EXIT_ON_EXCEPTION:
                     exit(1)
@@ -503,83 +1682,217 @@ def main(args=sys.argv):
                 cprint(f"[SUCCESS] `configure-dms-viz format` completed successfully!", color=colors.GREEN)
 
         # join all metric dmsviz files into one
-        metric_final_name = "all_metrics"
-        metric_final_long_name = "All Metrics"
-        description_final = f"{pdb_prefix} :: {chain_str} :: {metric_final_long_name}"
-        dmsviz_final_path = f"{temp_dir}/{pdb_prefix}.{chain_str}.{metric_final_name}.dmsviz.json"
+        dmsviz_final_path = f"{self.temp_dir}/{dataset_get_name(pdb_prefix, chainid, METRIC_FINAL_NAME, region)}.dmsviz.json"
         try:
-            dmsviz_join(
-                input_paths=dmsviz_paths,
-                output_path=dmsviz_final_path,
-                # description=description_final,
-            )
-
-            # add summary data entry
-            summary_data["dmsviz_filepath"].append(os.path.basename(dmsviz_final_path))
-            summary_data["pdb_filepath"].append(os.path.basename(pdb_path))
-            summary_data["pdbid"].append(pdb_prefix)
-            summary_data["pdbid_long_name"].append(pdb_prefix)
-            summary_data["chainid"].append(chain_str)
-            summary_data["chainid_long_name"].append(chain_long_names[chainid])
-            summary_data["metric"].append(metric_final_name)
-            summary_data["metric_long_name"].append(metric_final_long_name)
-            summary_data["description"].append(description_final)
-
+            self.join_datasets(input_paths=dmsviz_paths, output_path=dmsviz_final_path)
+            self.add_summary_entry(
+                dmsviz_final_path, pdb_path, chainid, chainid_long_name,
+                METRIC_FINAL_NAME, METRIC_FINAL_LONG_NAME,
+                self.get_description(pdb_path, chainid, METRIC_FINAL_NAME, region),
+                **region_fields)
         except Exception as e:
-            cprint(f"[ERROR] {pdb_prefix} {chainid}", color=colors.RED)
+            cprint(f"[ERROR] {pdb_prefix} {chainid} {region or ''}", color=colors.RED)
             cprint(f"[ERROR] error occurred during `configure-dms-viz join`: {e}", color=colors.RED)
             if EXIT_ON_EXCEPTION:
                 exit(1)
         else:
             cprint(f"[SUCCESS] `configure-dms-viz join` completed successfully!", color=colors.GREEN)
+        return dmsviz_paths
+
+    def run_pdb(self, pdb_path):
+        pdb_prefix = pdb_get_prefix(pdb_path)
+        all_dmsviz_paths = []
+        for (_pdb_path, chainid) in self.load_structures():
+            # skip if not in focal_chainids
+            if (_pdb_path != pdb_path) or (chainid not in self.focal_chainids):
+                continue
+            all_dmsviz_paths += self.run_chain(pdb_path, chainid)
+
+        # join all chains and metric dmsviz files into one
+        chain_str = "ALL"
+        chain_str_long = "All Chains"
+        dmsviz_final_path = f"{self.temp_dir}/{pdb_prefix}.{chain_str}.{METRIC_FINAL_NAME}.dmsviz.json"
+        try:
+            self.join_datasets(input_paths=all_dmsviz_paths, output_path=dmsviz_final_path)
+            self.add_summary_entry(
+                dmsviz_final_path, pdb_path, chain_str, chain_str_long,
+                METRIC_FINAL_NAME, METRIC_FINAL_LONG_NAME,
+                f"{pdb_prefix} :: {METRIC_FINAL_LONG_NAME}")
+        except Exception as err:
+            cprint(f"[ERROR] {pdb_prefix} {chain_str}", color=colors.RED)
+            cprint(f"[ERROR] error occurred during `configure-dms-viz join`: {err}", color=colors.RED)
+            if EXIT_ON_EXCEPTION:
+                exit(1)
+        else:
+            cprint(f"[SUCCESS] `configure-dms-viz join` completed successfully!", color=colors.GREEN)
+        return all_dmsviz_paths
+
+    def run(self):
+        os.makedirs(self.temp_dir, exist_ok=True)
+        # outputs of an interrupted run are not tied to any parameters
+        if os.path.exists(self.get_run_params_path()):
+            os.remove(self.get_run_params_path())
+        self.load()
+        print(self.pdb_paths)
+        pprint.pp(self.get_aa_seqs())
+        self.summary_data = {field: [] for field in SUMMARY_FIELDS}
+        for pdb_path in self.pdb_paths:
+            self.run_pdb(pdb_path)
+        if self.warehouse_dir is not None:
+            self.write_warehouse()
+        return self.write_summary()
+
+    def write_summary(self):
+        summary_df = pd.DataFrame(self.summary_data)
+        summary_df.assign(summary_stats=summary_df["summary_stats"].map(json.dumps)).to_csv(
+            f"{self.temp_dir}/summary.csv", index=False)
+        summary_json = summary_df.to_json(orient='records')
+        with open(f"{self.temp_dir}/summary.json", "w") as file:
+            file.write(f"{summary_json}\n")
+        with open(self.get_run_params_path(), "w") as file:
+            json.dump({"hash": self.get_run_params_hash(), "params": self.get_run_params()}, file, default=str)
+        print(summary_df)
+        return summary_df
+
+    def export(self, output_dir):
+        temp_jsons = glob.glob(f"{self.temp_dir}/*.dmsviz.json")
+        for temp_json in temp_jsons:
+            if os.path.basename(temp_json).startswith("_"):
+                continue
+            shutil.copy(temp_json, f"{output_dir}/dmsviz-jsons/")
+        shutil.copy(f"{self.temp_dir}/summary.csv", f"{output_dir}/metadata/summary.csv")
+        shutil.copy(f"{self.temp_dir}/summary.json", f"{output_dir}/metadata/summary.json")
+
+    # ** plan
+
+    def get_run_params_path(self):
+        return f"{self.temp_dir}/{RUN_PARAMS_NAME}"
+
+    def get_run_params(self):
+        # everything besides the input files that changes the written datasets
+        return {
+            "pdb_paths": self.pdb_paths,
+            "metric_path": self.metric_path,
+            "targets": self.targets,
+            "chunksize": self.chunksize,
+            "site_mapping": self.site_mapping,
+            "regions": self.regions,
+            "heavy_chainids": self.heavy_chainids,
+            "light_chainids": self.light_chainids,
+            "metric_names": self.metric_names,
+            "metric_long_names": self.metric_long_names,
+            "chain_long_names": self.chain_long_names,
+            "derived_metrics": self.derived_metrics,
+        }
+
+    def get_run_params_hash(self):
+        return sequence_get_hash(json.dumps(self.get_run_params(), sort_keys=True, default=str))
+
+    def get_last_run_params_hash(self):
+        if not os.path.exists(self.get_run_params_path()):
+            return None
+        with open(self.get_run_params_path(), "r") as file:
+            return json.load(file).get("hash")
+
+    def get_manifest_regions(self):
+        # regions are only known once the metric table is read, so they are taken from the last manifest
+        regions = {}
+        manifest_path = f"{self.temp_dir}/summary.json"
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                for entry in json.load(file):
+                    region = entry.get("region", REGION_ALL)
+                    if region != REGION_ALL:
+                        regions.setdefault((entry["pdbid"], entry["chainid"]), {})[region] = None
+        return {key: list(value) for key, value in regions.items()}
+
+    def plan(self):
+        # Lists the format and join jobs of a run from file metadata alone, without parsing
+        # structures or the metric table.
+        chain_rows = metric_estimate_rows(self.metric_path) / max(len(self.focal_chainids), 1)
+        manifest_regions = (self.get_manifest_regions() if self.regions else {})
+        params_match = (self.get_last_run_params_hash() == self.get_run_params_hash())
+        if not params_match and os.path.exists(f"{self.temp_dir}/summary.json"):
+            cprint("[WARNING] run parameters differ from the last completed run, so existing outputs are stale", color=colors.YELLOW)
+        if self.regions and len(manifest_regions) == 0:
+            cprint("[WARNING] region jobs are not listed until a run with --regions has written a manifest", color=colors.YELLOW)
+
+        jobs = []
+        for pdb_path in self.pdb_paths:
+            pdb_prefix = pdb_get_prefix(pdb_path)
+            pdb_size = os.path.getsize(pdb_path)
+            chainids = structure_scan_chainids(pdb_path)
+            pdb_join_inputs = []
+            for chainid in self.focal_chainids:
+                if (chainids is not None) and (chainid not in chainids):
+                    continue
+                regions = manifest_regions.get((pdb_prefix, chainid), [])
+                for region in [None] + regions:
+                    region_share = (1.0 if region is None else 1.0 / len(regions))
+                    fields = {"pdbid": pdb_prefix, "chainid": chainid, "region": (region or REGION_ALL)}
+                    format_jobs = []
+                    for metric_name, metric_cols in self.metric_names.items():
+                        est_bytes = pdb_size + len(metric_cols) * chain_rows * region_share * PLAN_BYTES_PER_VALUE
+                        format_jobs.append(plan_get_job(
+                            "format",
+                            f"{self.temp_dir}/{dataset_get_name(pdb_prefix, chainid, metric_name, region)}.dmsviz.json",
+                            [pdb_path, self.metric_path], est_bytes, params_match=params_match, metric=metric_name, **fields))
+                    jobs += format_jobs
+                    jobs.append(plan_get_job(
+                        "join",
+                        f"{self.temp_dir}/{dataset_get_name(pdb_prefix, chainid, METRIC_FINAL_NAME, region)}.dmsviz.json",
+                        [], sum(job["size"] for job in format_jobs), input_jobs=format_jobs, metric=METRIC_FINAL_NAME, **fields))
+                    if region is None:
+                        pdb_join_inputs += format_jobs
+            jobs.append(plan_get_job(
+                "join",
+                f"{self.temp_dir}/{pdb_prefix}.ALL.{METRIC_FINAL_NAME}.dmsviz.json",
+                [], sum(job["size"] for job in pdb_join_inputs), input_jobs=pdb_join_inputs,
+                pdbid=pdb_prefix, chainid="ALL", region=REGION_ALL, metric=METRIC_FINAL_NAME))
+        return jobs
+
+
+### MAIN ###
 
-    # join all metric dmsviz files into one
-    metric_final_name = "all_metrics"
-    metric_final_long_name = "All Metrics"
-    chain_str = "ALL"
-    chain_str_long = "All Chains"
-    description_final = f"{pdb_prefix} :: {metric_final_long_name}"
-    dmsviz_final_path = f"{temp_dir}/{pdb_prefix}.{chain_str}.{metric_final_name}.dmsviz.json"
-    try:
-        dmsviz_join(
-            input_paths=all_dmsviz_paths,
-            output_path=dmsviz_final_path,
-            # description=description_final,
-        )
-
-        # add summary data entry
-        summary_data["dmsviz_filepath"].append(os.path.basename(dmsviz_final_path))
-        summary_data["pdb_filepath"].append(os.path.basename(pdb_path))
-        summary_data["pdbid"].append(pdb_prefix)
-        summary_data["pdbid_long_name"].append(pdb_prefix)
-        summary_data["chainid"].append(chain_str)
-        summary_data["chainid_long_name"].append(chain_str_long)
-        summary_data["metric"].append(metric_final_name)
-        summary_data["metric_long_name"].append(metric_final_long_name)
-        summary_data["description"].append(description_final)
-
-    except Exception as err:
-        cprint(f"[ERROR] {pdb_prefix} {chainid}", color=colors.RED)
-        cprint(f"[ERROR] error occurred during `configure-dms-viz join`: {err}", color=colors.RED)
-        if EXIT_ON_EXCEPTION:
-            exit(1)
-    else:
-        cprint(f"[SUCCESS] `configure-dms-viz join` completed successfully!", color=colors.GREEN)
 
-    summary_df = pd.DataFrame(summary_data)
-    summary_df.to_csv(f"{temp_dir}/summary.csv", index=False)
-    summary_json = summary_df.to_json(orient='records')
-    with open(f"{temp_dir}/summary.json", "w") as file:
-        # json.dump(summary_json, file)
-        file.write(f"{summary_json}\n")
-    print(summary_df)
+def parse_args(args):
+    arg_parser = argparse.ArgumentParser("gcreplay-viz pipeline")
+    arg_parser.add_argument("--input-dir", type=Parser.parse_input_dir(), help="input directory for structures (.pdb, .cif, .cif.gz, .bcif) and metrics")
+    arg_parser.add_argument("--output-dir", type=Parser.parse_output_dir(), help="output directory for dms-viz jsons")
+    arg_parser.add_argument("--warehouse-dir", type=Parser.parse_output_dir(), help="output directory for partitioned parquet metrics")
+    arg_parser.add_argument("--target", type=Parser.parse_list(str), help="only use metric rows for these targets")
+    arg_parser.add_argument("--chunksize", type=int, help="stream the metric table in chunks of this many rows")
+    arg_parser.add_argument("--derived-metric", type=Parser.parse_list(parse_derived), help="derived metric groups as <stat>:<cohort>+<cohort>, e.g. event_share:15-day+20-day,log2_abundance_over_events:LMP2A")
+    arg_parser.add_argument("--site-mapping", type=Parser.parse_option(SITE_MAPPING_MODES), help="map structure residues to metric sites by numbering, sequence alignment, or auto", default="auto")
+    arg_parser.add_argument("--regions", action="store_true", help="also write datasets partitioned by annotation region (FWR/CDR)")
+    arg_parser.add_argument("--plan", action="store_true", help="list the format and join jobs with cached/stale status and estimated sizes, then exit")
+    arg_parser.add_argument("--temp-dir", type=Parser.parse_output_dir(), help="temporary directory", default="_temp")
+    arg_parser.add_argument("--chain-id", type=Parser.parse_list(str), help="heavy chain ids", default=["H"])
+    arg_parser.add_argument("--light-chain-id", type=Parser.parse_list(str), help="light chain ids", default=["L"])
+    parser = Parser(arg_parser=arg_parser)
+    args = parser.parse_args(args[1:])
+    return args
+
 
+def main(args=sys.argv):
+    args = parse_args(args)
+    session = PipelineSession(
+        input_dir=args['input_dir'],
+        temp_dir=args['temp_dir'],
+        heavy_chainids=args['chain_id'],
+        light_chainids=args['light_chain_id'],
+        warehouse_dir=args['warehouse_dir'],
+        targets=args['target'],
+        chunksize=args['chunksize'],
+        derived_metrics=derived_parse(args['derived_metric']),
+        site_mapping=args['site_mapping'],
+        regions=args['regions'])
+    if args['plan']:
+        plan_print(session.plan())
+        return
+    session.run()
     if args['output_dir'] is not None:
-        temp_jsons = glob.glob(f"{temp_dir}/*.dmsviz.json")
-        for temp_json in temp_jsons:
-            shutil.copy(temp_json, f"{output_dir}/dmsviz-jsons/")
-        shutil.copy(f"{temp_dir}/summary.csv", f"{output_dir}/metadata/summary.csv")
-        shutil.copy(f"{temp_dir}/summary.json", f"{output_dir}/metadata/summary.json")
+        session.export(args['output_dir'])
     return
 
 
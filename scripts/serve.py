@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import os,sys
+import argparse
+import gzip
+import hashlib
+import mimetypes
+import re
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import quote
+
+from utility import *
+
+# encodings in order of preference, with the suffix of their precompressed siblings
+ENCODINGS = {
+    "br": ".br",
+    "gzip": ".gz",
+}
+COMPRESSIBLE_TYPES = ["text/", "application/json", "application/javascript", "chemical/", "image/svg+xml"]
+COMPRESS_MIN_BYTES = 1024
+CACHE_MAX_BYTES = 256 * 2**20
+PRECOMPRESS_DIRS = ["data/dmsviz-jsons", "data/metadata"]
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def get_brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def is_compressible(content_type):
+    return any(content_type.startswith(x) for x in COMPRESSIBLE_TYPES)
+
+
+def parse_accept_encoding(header):
+    # encodings the client accepts, ignoring any with q=0
+    accepted = set()
+    for part in (header or "").split(","):
+        fields = [x.strip() for x in part.split(";")]
+        if fields[0] == "":
+            continue
+        if any(x.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for x in fields[1:]):
+            continue
+        accepted.add(fields[0].lower())
+    return accepted
+
+
+def parse_range(header, size):
+    # single byte range as (start, end) inclusive, None if absent or unsatisfiable
+    match = RANGE_PATTERN.match((header or "").strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if start == "" and end == "":
+        return None
+    if start == "":
+        length = int(end)
+        if length == 0:
+            return None
+        return (max(size - length, 0), size - 1)
+    start = int(start)
+    end = (size - 1) if end == "" else min(int(end), size - 1)
+    if start > end:
+        return None
+    return (start, end)
+
+
+class Representation:
+    # File body in one content encoding, with a strong ETag over its bytes.
+    # Cached per (path, encoding): a changed file replaces its entry, and least recently used
+    # entries are evicted once the cached bodies exceed `max_bytes`.
+    _cache = OrderedDict()
+    _cache_bytes = 0
+    _lock = threading.Lock()
+    max_bytes = CACHE_MAX_BYTES
+
+    def __init__(self, body, encoding, etag):
+        self.body = body
+        self.encoding = encoding
+        self.etag = etag
+
+    @staticmethod
+    def load(path, encoding=None, compress=False):
+        stat = os.stat(path)
+        key = (str(path), encoding)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with Representation._lock:
+            entry = Representation._cache.get(key)
+            if (entry is not None) and (entry[0] == version):
+                Representation._cache.move_to_end(key)
+                return entry[1]
+
+        with open(path, "rb") as file:
+            body = file.read()
+        if compress and encoding == "gzip":
+            body = gzip.compress(body, mtime=0)
+        elif compress and encoding == "br":
+            body = get_brotli().compress(body)
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        rep = Representation(body, encoding, etag)
+        Representation.cache_put(key, version, rep)
+        return rep
+
+    @staticmethod
+    def cache_put(key, version, rep):
+        cls = Representation
+        with cls._lock:
+            old_entry = cls._cache.pop(key, None)
+            if old_entry is not None:
+                cls._cache_bytes -= len(old_entry[1].body)
+            if len(rep.body) > cls.max_bytes:
+                return
+            cls._cache[key] = (version, rep)
+            cls._cache_bytes += len(rep.body)
+            while cls._cache_bytes > cls.max_bytes:
+                _, (_, old_rep) = cls._cache.popitem(last=False)
+                cls._cache_bytes -= len(old_rep.body)
+
+
+class StaticHandler(SimpleHTTPRequestHandler):
+    # Serves the viewer and its data with content negotiation, strong ETags and byte ranges.
+    protocol_version = "HTTP/1.1"
+    max_age = 0
+    compress = True
+
+    def end_headers(self):
+        # dms-viz fetches the data from its own origin
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Expose-Headers", "Content-Length, Content-Range, Content-Encoding, ETag")
+        super().end_headers()
+
+    def do_OPTIONS(self):
+        self.send_response(HTTPStatus.NO_CONTENT)
+        self.send_header("Access-Control-Allow-Methods", "GET, HEAD, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Range, If-None-Match")
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_static(head_only=False)
+
+    def do_HEAD(self):
+        self.send_static(head_only=True)
+
+    def select_representation(self, path, content_type):
+        # ranges are served from the identity encoding, so offsets refer to the file on disk
+        if self.headers.get("Range"):
+            return Representation.load(path)
+        accepted = parse_accept_encoding(self.headers.get("Accept-Encoding"))
+        for encoding, suffix in ENCODINGS.items():
+            if encoding not in accepted:
+                continue
+            sibling = f"{path}{suffix}"
+            # a sibling older than its source is left over from a previous export
+            if os.path.isfile(sibling) and (os.path.getmtime(sibling) >= os.path.getmtime(path)):
+                return Representation.load(sibling, encoding=encoding)
+        if self.compress and is_compressible(content_type) and (os.path.getsize(path) >= COMPRESS_MIN_BYTES):
+            for encoding in ENCODINGS:
+                if (encoding in accepted) and (encoding != "br" or get_brotli() is not None):
+                    return Representation.load(path, encoding=encoding, compress=True)
+        return Representation.load(path)
+
+    def send_static(self, head_only=False):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            path = os.path.join(path, "index.html")
+        if not os.path.isfile(path):
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return
+        content_type = self.guess_type(path)
+        rep = self.select_representation(path, content_type)
+
+        # conditional request
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match and (rep.etag in [x.strip() for x in if_none_match.split(",")] or if_none_match.strip() == "*"):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_common_headers(rep)
+            self.end_headers()
+            return
+
+        body = rep.body
+        status = HTTPStatus.OK
+        content_range = None
+        if self.headers.get("Range"):
+            byte_range = parse_range(self.headers.get("Range"), len(body))
+            # If-Range with a stale validator falls back to the full body
+            if_range = self.headers.get("If-Range")
+            if (byte_range is not None) and (if_range is None or if_range.strip() == rep.etag):
+                start, end = byte_range
+                content_range = f"bytes {start}-{end}/{len(body)}"
+                body = body[start:end + 1]
+                status = HTTPStatus.PARTIAL_CONTENT
+            elif byte_range is None and RANGE_PATTERN.match(self.headers.get("Range").strip()):
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.send_common_headers(rep)
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def send_common_headers(self, rep):
+        self.send_header("ETag", rep.etag)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Vary", "Accept-Encoding")
+        if rep.encoding:
+            self.send_header("Content-Encoding", rep.encoding)
+        if self.max_age > 0:
+            self.send_header("Cache-Control", f"public, max-age={self.max_age}")
+        else:
+            self.send_header("Cache-Control", "no-cache")
+
+
+def precompress_dir(root_dir, min_bytes=COMPRESS_MIN_BYTES):
+    # write .gz (and .br, if brotli is installed) siblings for compressible files
+    brotli = get_brotli()
+    for path in sorted(Path(root_dir).rglob("*")):
+        if (not path.is_file()) or (path.suffix in (".gz", ".br")):
+            continue
+        content_type = mimetypes.guess_type(str(path))[0] or ""
+        if (not is_compressible(content_type)) or (path.stat().st_size < min_bytes):
+            continue
+        body = path.read_bytes()
+        Path(f"{path}.gz").write_bytes(gzip.compress(body, compresslevel=9, mtime=0))
+        if brotli is not None:
+            Path(f"{path}.br").write_bytes(brotli.compress(body))
+        print(f"precompressed: {path}")
+
+
+def parse_args(args):
+    arg_parser = argparse.ArgumentParser("gcreplay-viz local server")
+    arg_parser.add_argument("--root-dir", type=Parser.parse_input_dir(), help="directory to serve", default=str(Path(__file__).resolve().parent.parent))
+    arg_parser.add_argument("--host", type=str, help="host to bind", default="localhost")
+    arg_parser.add_argument("--port", type=int, help="port to bind", default=8000)
+    arg_parser.add_argument("--max-age", type=int, help="Cache-Control max-age in seconds (0 revalidates every request)", default=0)
+    arg_parser.add_argument("--cache-mb", type=int, help="memory limit for cached file bodies in MiB", default=CACHE_MAX_BYTES // 2**20)
+    arg_parser.add_argument("--no-compress", action="store_true", help="only serve precompressed siblings, never compress on the fly")
+    arg_parser.add_argument("--precompress", action="store_true", help="write .gz/.br siblings for the dms-viz jsons and metadata, then exit")
+    parser = Parser(arg_parser=arg_parser)
+    args = parser.parse_args(args[1:])
+    return args
+
+
+### MAIN ###
+
+
+def main(args=sys.argv):
+    args = parse_args(args)
+    root_dir = args["root_dir"]
+    if args["precompress"]:
+        for data_dir in PRECOMPRESS_DIRS:
+            precompress_dir(f"{root_dir}/{data_dir}")
+        return
+
+    mimetypes.add_type("application/json", ".json")
+    mimetypes.add_type("chemical/x-pdb", ".pdb")
+    StaticHandler.max_age = args["max_age"]
+    StaticHandler.compress = not args["no_compress"]
+    Representation.max_bytes = args["cache_mb"] * 2**20
+
+    def handler(*handler_args, **handler_kwargs):
+        return StaticHandler(*handler_args, directory=root_dir, **handler_kwargs)
+
+    server = ThreadingHTTPServer((args["host"], args["port"]), handler)
+    base_url = f"http://{args['host']}:{args['port']}"
+    cprint(f"[SERVE] {root_dir} at {base_url}", color=colors.GREEN)
+    cprint(f"[SERVE] open {base_url}/?data_base={quote(base_url, safe='')}", color=colors.GREEN)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
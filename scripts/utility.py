@@ -1,6 +1,7 @@
 import os, sys
 import subprocess
 import argparse
+import importlib
 import re
 from pathlib import Path
 from collections import defaultdict
@@ -150,6 +151,18 @@ class Parser:
 ### utilities ###
 
 
+class LazyModule:
+    # Stands in for a module and imports it on first attribute access.
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
 def run_command(command, do_print=True):
     if do_print:
         print(f"COMMAND: {command}")